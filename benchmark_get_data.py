@@ -0,0 +1,103 @@
+"""
+benchmark get_data.py against a local stand-in for the IBL server: sessions/second, peak memory and failure handling
+
+"""
+
+# ============================================ #
+# GETTING STARTED
+# ============================================ #
+
+from optparse import OptionParser
+import pandas as pd
+import numpy as np
+import os, sys, time, shutil
+
+from utils_local_one import make_fixture
+from utils_get_data import SessionManifest
+
+# read inputs
+parser = OptionParser("benchmark_get_data.py [options]")
+parser.add_option("-s", "--n_subjects",
+                  default=20,
+                  type="int",
+                  help="number of simulated mice")
+parser.add_option("-t", "--n_trials",
+                  default=600,
+                  type="int",
+                  help="number of trials per session")
+parser.add_option("-j", "--n_jobs",
+                  default="1,4,16",
+                  help="comma-separated list of concurrency levels to benchmark")
+parser.add_option("--latency",
+                  default=0.05,
+                  type="float",
+                  help="seconds to wait for each request")
+parser.add_option("--failure_rate",
+                  default=0.02,
+                  type="float",
+                  help="fraction of requests that fail")
+parser.add_option("-o", "--outpath",
+                  default=os.path.join('data', 'benchmark'),
+                  help="where to put the fixture and the results")
+opts, args = parser.parse_args()
+
+fixturepath = os.path.join(opts.outpath, 'fixture_%dsj_%dtrials'%(opts.n_subjects, opts.n_trials))
+if not os.path.exists(fixturepath):
+    print('making fixture in %s'%fixturepath)
+    make_fixture(fixturepath, n_subjects=opts.n_subjects, n_trials=opts.n_trials)
+
+
+def run_get_data(datapath, n_jobs, failure_rate, rebuild):
+    """
+    Run get_data.py on the fixture, return its wall time (s) and peak memory (MB)
+    """
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'get_data.py'),
+           '--local', fixturepath, '--datapath', datapath, '-j', str(n_jobs),
+           '--latency', str(opts.latency), '--failure_rate', str(failure_rate)]
+    if rebuild: cmd.append('-r')
+
+    t0 = time.time()
+    # spawned and reaped here, so that wait4 gives the resource usage of this run only
+    quiet = [(os.POSIX_SPAWN_OPEN, fd, os.devnull, os.O_WRONLY, 0) for fd in [1, 2]]
+    pid = os.posix_spawn(cmd[0], cmd, os.environ, file_actions=quiet)
+    _, status, usage = os.wait4(pid, 0)
+    elapsed = time.time() - t0
+    if os.waitstatus_to_exitcode(status) != 0:
+        print('get_data.py exited with status %d'%os.waitstatus_to_exitcode(status))
+    return elapsed, usage.ru_maxrss / 1024 # ru_maxrss is in kB on linux
+
+
+def manifest_counts(datapath):
+    # the manifest file is a log with a row per status change, count each session's latest status
+    manifest = SessionManifest(os.path.join(datapath, 'ibl_trainingchoiceworld_manifest.csv'))
+    return manifest.sessions['status'].value_counts()
+
+# ============================================ #
+# RUN THE BENCHMARK
+# ============================================ #
+
+results = []
+for n_jobs in [int(j) for j in opts.n_jobs.split(',')]:
+    datapath = os.path.join(opts.outpath, 'run_j%d'%n_jobs)
+    if os.path.exists(datapath): shutil.rmtree(datapath)
+
+    # 1. a fresh run, with injected failures
+    elapsed, peak_mb = run_get_data(datapath, n_jobs, opts.failure_rate, rebuild=True)
+    counts = manifest_counts(datapath)
+    results.append({'n_jobs': n_jobs, 'run': 'fresh', 'seconds': elapsed, 'peak_mb': peak_mb,
+                    'written': counts.get('written', 0), 'failed': counts.get('failed', 0),
+                    'sessions_per_s': counts.get('written', 0) / elapsed})
+
+    # 2. re-run without failures: only the failed sessions should be loaded again
+    elapsed, peak_mb = run_get_data(datapath, n_jobs, 0., rebuild=False)
+    counts_rerun = manifest_counts(datapath)
+    retried = counts_rerun.get('written', 0) - counts.get('written', 0)
+    results.append({'n_jobs': n_jobs, 'run': 'resume', 'seconds': elapsed, 'peak_mb': peak_mb,
+                    'written': counts_rerun.get('written', 0), 'failed': counts_rerun.get('failed', 0),
+                    'sessions_per_s': retried / elapsed})
+    if counts_rerun.get('failed', 0) > 0:
+        print('%d sessions still failed after the re-run with n_jobs = %d'%(counts_rerun['failed'], n_jobs))
+
+results = pd.DataFrame(results)
+print(results.to_string(index=False, float_format='%.2f'))
+results.to_csv(os.path.join(opts.outpath, 'benchmark_get_data.csv'), index=False)
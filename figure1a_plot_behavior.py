@@ -13,26 +13,32 @@ import seaborn as sns
 import brainbox as bb
 import utils_plot as tools
 import utils_choice_history as more_tools
+from utils_data import load_trials, sufficient_statistics
 
 ## INITIALIZE A FEW THINGS
 tools.seaborn_style()
 
 datapath = 'data'
 figpath = 'figures'
+# shared psychometric fit cache
+fit_cache = tools.FitCache(os.path.join(datapath, 'psychfunc_fits.csv'))
 
-data = pd.read_csv(os.path.join(datapath, 'ibl_trainingchoiceworld_clean.csv'))
+data = load_trials(os.path.join(datapath, 'ibl_trainingchoiceworld_clean'),
+                   columns=['subj_idx', 'signed_contrast', 'response', 'rt'])
+# the plots below only need counts and RT quantiles per mouse and contrast
+cube = sufficient_statistics(data)
 
 # %% ================================= #
 # REGULAR PSYCHFUNCS
 # ================================= #
 
-fig = sns.FacetGrid(data, hue="subj_idx")
-fig.map(tools.plot_psychometric, "signed_contrast", "response",
-        "subj_idx", color='lightgrey', alpha=0.3)
+fig = sns.FacetGrid(cube, hue="subj_idx")
+fig.map(tools.plot_psychometric, "signed_contrast", "fraction",
+        "subj_idx", "ntrials", cache=fit_cache, color='lightgrey', alpha=0.3)
 # add means on top
 for axidx, ax in enumerate(fig.axes.flat):
-    tools.plot_psychometric(data.signed_contrast, data.response,
-                      data.subj_idx, ax=ax, legend=False, color='darkblue', linewidth=2)
+    tools.plot_psychometric(cube.signed_contrast, cube.fraction,
+                      cube.subj_idx, cube.ntrials, cache=fit_cache, ax=ax, legend=False, color='darkblue', linewidth=2)
 
 #fig.map(sns.lineplot, "signed_contrast", "response", color='gray', alpha=0.7)     
 fig.despine(trim=True)
@@ -45,12 +51,12 @@ fig.savefig(os.path.join(figpath, "psychfuncs_allmice.pdf"))
 # CHRONFUNCS on good RTs
 # ================================= #
 
-fig = sns.FacetGrid(data, hue="subj_idx")
-fig.map(tools.plot_chronometric, "signed_contrast", "rt", 
+fig = sns.FacetGrid(cube, hue="subj_idx")
+fig.map(tools.plot_chronometric, "signed_contrast", "rt_median", 
     "subj_idx", color='lightgray', alpha=0.3)
 for axidx, ax in enumerate(fig.axes.flat):
-    tools.plot_chronometric(data.signed_contrast, data.rt,
-                      data.subj_idx, ax=ax, legend=False, color='darkblue', linewidth=2)
+    tools.plot_chronometric(cube.signed_contrast, cube.rt_median,
+                      cube.subj_idx, ax=ax, legend=False, color='darkblue', linewidth=2)
 fig.despine(trim=True)
 fig.set_axis_labels('Signed contrast (%)', 'RT (s)')
 ax.set_title('b. Chronometric function (n = %d)'%data.subj_idx.nunique())
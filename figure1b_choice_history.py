@@ -13,6 +13,7 @@ import seaborn as sns
 import brainbox.behavior.pyschofit as psy
 import utils_plot as tools
 import utils_choice_history as more_tools
+from utils_data import load_trials, sufficient_statistics
 
 ## INITIALIZE A FEW THINGS
 sns.set(style="ticks", context="paper", palette="colorblind")
@@ -20,14 +21,19 @@ tools.seaborn_style()
 
 datapath = 'data'
 figpath = 'figures'
+# shared psychometric fit cache
+fit_cache = tools.FitCache(os.path.join(datapath, 'psychfunc_fits.csv'))
 
 # %% ================================= #
 # USE THE SAME FILE AS FOR HDDM FITS
 # ================================= #
 
-data = pd.read_csv(os.path.join(datapath, 'ibl_trainingchoiceworld_clean.csv'))
+data = load_trials(os.path.join(datapath, 'ibl_trainingchoiceworld_clean'),
+                   columns=['subj_idx', 'signed_contrast', 'response', 'rt', 'prevresp', 'prevfb'])
 data.head(n=10)
-data['previous_trial'] = 100*data.prevfb + 10*data.prevresp  # for color coding
+# the plots below only need counts and RT quantiles per mouse, contrast and previous trial
+cube = sufficient_statistics(data, conditions=['prevresp', 'prevfb'])
+cube['previous_trial'] = 100*cube.prevfb.astype(float) + 10*cube.prevresp.astype(float)  # for color coding
 cmap = sns.color_palette("Paired")
 cmap = cmap[4:]
 
@@ -36,9 +42,9 @@ cmap = cmap[4:]
 # ================================= #
 
 # plot one curve for each animal, one panel per lab
-fig = sns.FacetGrid(data, hue='previous_trial', palette=cmap,
+fig = sns.FacetGrid(cube, hue='previous_trial', palette=cmap,
 					hue_order=[-90., +110.,  -100., +100.])
-fig.map(tools.plot_psychometric, "signed_contrast", "response", "subj_idx")
+fig.map(tools.plot_psychometric, "signed_contrast", "fraction", "subj_idx", "ntrials", cache=fit_cache)
 fig.set_axis_labels('Signed contrast (%)', 'Rightward choice (%)')
 for axidx, ax in enumerate(fig.axes.flat):
         ax.set_title('c. History-dependent psychometric')
@@ -83,9 +89,9 @@ plt.close('all')
 
 #%% also previous history chronometric 
 # plot one curve for each animal, one panel per lab
-fig = sns.FacetGrid(data, hue='previous_trial', palette=cmap,
+fig = sns.FacetGrid(cube, hue='previous_trial', palette=cmap,
 					hue_order=[-90., +110.,  -100., +100.])
-fig.map(tools.plot_chronometric, "signed_contrast", "rt", "subj_idx")
+fig.map(tools.plot_chronometric, "signed_contrast", "rt_median", "subj_idx")
 fig.set_axis_labels('Signed contrast (%)', 'RT (s)')
 for axidx, ax in enumerate(fig.axes.flat):
         ax.set_title('d. History-dependent chronometric')
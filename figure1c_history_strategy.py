@@ -10,9 +10,9 @@ import sys, os, time
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import seaborn as sns
-import brainbox.behavior.pyschofit as psy
 import utils_plot as tools
 import utils_choice_history as more_tools
+from utils_data import load_trials
 
 ## INITIALIZE A FEW THINGS
 sns.set(style="ticks", context="paper", palette="colorblind")
@@ -20,12 +20,21 @@ tools.seaborn_style()
 
 datapath = 'data'
 figpath = 'figures'
+# shared psychometric fit cache
+fit_cache = tools.FitCache(os.path.join(datapath, 'psychfunc_fits.csv'))
+# processes for the psychometric fits; make_figures.py sets FIGURE_N_JOBS=1, as it already runs several scripts at once
+n_jobs = int(os.environ.get('FIGURE_N_JOBS', os.cpu_count()))
+# python figure1c_history_strategy.py --bootstrap: 95% confidence intervals for each mouse in the strategy space
+bootstrap = '--bootstrap' in sys.argv
+n_boot = 1000
 
 # %% ================================= #
 # USE THE SAME FILE AS FOR HDDM FITS
 # ================================= #
 
-data = pd.read_csv(os.path.join(datapath, 'ibl_trainingchoiceworld_clean.csv'))
+data = load_trials(os.path.join(datapath, 'ibl_trainingchoiceworld_clean'),
+                   columns=['subj_idx', 'signed_contrast', 'response', 'prevresp', 'prevfb', 'prevcontrast',
+                            'nextresp', 'nextfb', 'nextcontrast'])
 data.head(n=10)
 
 # %% ================================= #
@@ -33,39 +42,16 @@ data.head(n=10)
 # ================================= #
 
 print('fitting psychometric functions...')
-data['choice2'] = data.response
-data['choice'] = data.response
-data['trial'] = data.index
-pars = data.groupby(['subj_idx', 'previous_choice', 'previous_outcome']).apply(tools.fit_psychfunc).reset_index()
-
-# instead of the bias in % contrast, take the choice shift at x = 0
-# now read these out at the presented levels of signed contrast
-pars2 = pd.DataFrame([])
-xvec = data.signed_contrast.unique()
-for index, group in pars.groupby(['subj_idx', 'previous_choice', 'previous_outcome']):
-    # expand
-    yvec = psy.erf_psycho_2gammas([group.bias.item(),
-                                   group.threshold.item(),
-                                   group.lapselow.item(),
-                                   group.lapsehigh.item()], xvec)
-    group2 = group.loc[group.index.repeat(
-        len(yvec))].reset_index(drop=True).copy()
-    group2['signed_contrast'] = xvec
-    group2['response'] = 100 * yvec
-    # add this
-    pars2 = pars2.append(group2)
-
-# only pick psychometric functions that were fit on a reasonable number of trials...
-pars2 = pars2[(pars2.signed_contrast == 0)]
-
-# compute history-dependent bias shift
-pars3 = pd.pivot_table(pars2, values='response',
-                       index=['subj_idx', 'previous_outcome'],
-                       columns=['previous_choice']).reset_index()
-pars3['history_shift'] = pars3[1.0] - pars3[0.0]
-pars4 = pd.pivot_table(pars3, values='history_shift',
+# history-dependent bias shift: the choice shift at x = 0 after rightward vs. leftward choices
+if bootstrap:
+    shifts = tools.bootstrap_history_shifts(data, conditions=['fb'], xvec=[0.], n_boot=n_boot, correct=False,
+                                            n_jobs=n_jobs, cache=fit_cache)
+else:
+    shifts = tools.history_shifts(data, conditions=['fb'], xvec=[0.], correct=False, n_jobs=n_jobs,
+                                  cache=fit_cache)
+pars4 = pd.pivot_table(shifts, values='history_shift',
                        index=['subj_idx'],
-                       columns=['previous_outcome']).reset_index()
+                       columns=['prevfb']).reset_index()
 print(pars4.describe())
 
 # ================================= #
@@ -74,7 +60,13 @@ print(pars4.describe())
 
 plt.close('all')
 fig, ax = plt.subplots(1, 1, figsize=[3.5, 3.5])
-sns.scatterplot(x=pars4[1.], y=pars4[-1.], alpha=0.8, color='grey', ax=ax, legend=False)
+if bootstrap:
+    # bootstrap confidence intervals, in the same order as pars4
+    ci = pd.pivot_table(shifts, values=['history_shift_low', 'history_shift_high'],
+                        index=['subj_idx'], columns=['prevfb']).reindex(pars4.subj_idx)
+    ax.hlines(pars4[-1], ci['history_shift_low'][1], ci['history_shift_high'][1], color='silver', linewidth=0.5, zorder=0)
+    ax.vlines(pars4[1], ci['history_shift_low'][-1], ci['history_shift_high'][-1], color='silver', linewidth=0.5, zorder=0)
+sns.scatterplot(x=pars4[1], y=pars4[-1], alpha=0.8, color='grey', ax=ax, legend=False)
 ax.set_xlabel("History dependence after correct\n($\Delta$ rightward choice (%) at 0% contrast)")
 ax.set_ylabel("History dependence after error\n($\Delta$ rightward choice (%) at 0% contrast)")
 ax.set(xticks=[-20, 0, 20, 40, 60], yticks=[-20, 0, 20, 40, 60])
@@ -91,87 +83,14 @@ print('strategy space')
 # DEPENDENCE ON PREVIOUS CONTRAST
 # ================================= #
 
-print('fitting psychometric functions, NOW ALSO BASED ON PREVIOUS CONTRAST...')
-data['choice2'] = data.response
-data['choice'] = data.response
-data['trial'] = data.index
-pars = data.groupby(['subj_idx', 'previous_choice', 'previous_outcome', 'previous_contrast']).apply(
-    tools.fit_psychfunc).reset_index()
-
-# instead of the bias in % contrast, take the choice shift at x = 0
-# now read these out at the presented levels of signed contrast
-pars2 = pd.DataFrame([])
-xvec = data.signed_contrast.unique()
-for index, group in pars.groupby(['subj_idx', 'previous_choice', 'previous_outcome', 'previous_contrast']):
-    # expand
-    yvec = psy.erf_psycho_2gammas([group.bias.item(),
-                                   group.threshold.item(),
-                                   group.lapselow.item(),
-                                   group.lapsehigh.item()], xvec)
-    group2 = group.loc[group.index.repeat(
-        len(yvec))].reset_index(drop=True).copy()
-    group2['signed_contrast'] = xvec
-    group2['response'] = 100 * yvec
-    # add this
-    pars2 = pars2.append(group2)
-
-# only pick psychometric functions that were fit on a reasonable number of trials...
-pars2 = pars2.loc[pars2.ntrials > 50, :]
-pars2 = pars2[(pars2.signed_contrast == 0)]
-
-# compute history-dependent bias shift
-pars3 = pd.pivot_table(pars2, values='response',
-                       index=['subj_idx', 'previous_outcome', 'previous_contrast'],
-                       columns=['previous_choice']).reset_index()
-pars3['history_shift'] = pars3[1.0] - pars3[0.0]
+print('fitting psychometric functions, NOW ALSO BASED ON PREVIOUS AND NEXT CONTRAST...')
+# only pick psychometric functions that were fit on a reasonable number of trials,
+# and subtract the future shift from each history shift
+pars5 = tools.history_shifts(data, conditions=['fb', 'contrast'], xvec=[0.], min_trials=50,
+                             n_jobs=n_jobs, cache=fit_cache)
 # move the 100% closer
-pars3['previous_contrast'] = pars3.previous_contrast * 100
-pars3.loc[pars3.previous_contrast == 100, 'previous_contrast'] = 40
-
-# # ================================= #
-
-print('fitting psychometric functions, NOW ALSO BASED ON NEXT CONTRAST...')
-data['choice2'] = data.response
-data['choice'] = data.response
-data['trial'] = data.index
-pars = data.groupby(['subj_idx', 'next_choice', 'next_outcome', 'next_contrast']).apply(
-    tools.fit_psychfunc).reset_index()
-
-# instead of the bias in % contrast, take the choice shift at x = 0
-# now read these out at the presented levels of signed contrast
-pars2 = pd.DataFrame([])
-xvec = data.signed_contrast.unique()
-for index, group in pars.groupby(['subj_idx', 'next_choice', 'next_outcome', 'next_contrast']):
-    # expand
-    yvec = psy.erf_psycho_2gammas([group.bias.item(),
-                                   group.threshold.item(),
-                                   group.lapselow.item(),
-                                   group.lapsehigh.item()], xvec)
-    group2 = group.loc[group.index.repeat(
-        len(yvec))].reset_index(drop=True).copy()
-    group2['signed_contrast'] = xvec
-    group2['response'] = 100 * yvec
-    # add this
-    pars2 = pars2.append(group2)
-
-# only pick psychometric functions that were fit on a reasonable number of trials...
-pars2 = pars2[(pars2.signed_contrast == 0)]
-
-# compute history-dependent bias shift
-pars4 = pd.pivot_table(pars2, values='response',
-                       index=['subj_idx', 'next_outcome', 'next_contrast'],
-                       columns=['next_choice']).reset_index()
-pars4['future_shift'] = pars4[1.0] - pars4[0.0]
-
-pars4['previous_outcome'] = pars4.next_outcome
-pars4['previous_contrast'] = pars4.next_contrast
-pars4['previous_contrast'] = pars4.previous_contrast * 100
-pars4.loc[pars4.previous_contrast == 100, 'previous_contrast'] = 40
-
-# merge and subtract the future shift from each history shift
-pars5 = pd.merge(pars4, pars3,
-                 on=['subj_idx', 'previous_outcome', 'previous_contrast'])
-pars5['history_shift_corrected'] = pars5['history_shift'] - pars5['future_shift']
+pars5.loc[pars5.prevcontrast == 100, 'prevcontrast'] = 40
+pars3 = pars5
 
 # ================================= #
 # PLOT PREVIOUS CONTRAST-DEPENDENCE
@@ -179,12 +98,12 @@ pars5['history_shift_corrected'] = pars5['history_shift'] - pars5['future_shift'
 
 plt.close('all')
 fig, ax = plt.subplots(1, 2, figsize=[6,3], sharex=True, sharey=True)
-# sns.lineplot(data=pars3, x='previous_contrast', y='history_shift',
-#              hue='previous_outcome', ax=ax[0], legend=False,
+# sns.lineplot(data=pars3, x='prevcontrast', y='history_shift',
+#              hue='prevfb', ax=ax[0], legend=False,
 #              marker='o', units='subj_idx', estimator=None, linewidth=0, alpha=0.5,
 #              hue_order=[-1., 1.], palette=sns.color_palette(["tomato", "seagreen"]))
-sns.lineplot(data=pars3, x='previous_contrast', y='history_shift',
-             hue='previous_outcome', ax=ax[0], legend=False, estimator=np.median,
+sns.lineplot(data=pars3, x='prevcontrast', y='history_shift',
+             hue='prevfb', ax=ax[0], legend=False, estimator=np.median,
              err_style='bars', marker='o', hue_order=[-1., 1.],
              palette=sns.color_palette(["firebrick", "forestgreen"]))
 ax[0].set(ylabel='$\Delta$ Choice bias (%)',
@@ -194,12 +113,12 @@ ax[0].set(ylabel='$\Delta$ Choice bias (%)',
           title='Uncorrected')
 ax[0].axhline(color='grey')
 
-# sns.lineplot(data=pars5, x='previous_contrast', y='history_shift_corrected',
-#              hue='previous_outcome', ax=ax[1], legend=False,
+# sns.lineplot(data=pars5, x='prevcontrast', y='history_shift_corrected',
+#              hue='prevfb', ax=ax[1], legend=False,
 #              marker='o', units='subj_idx', estimator=None, linewidth=0, alpha=0.5,
 #              hue_order=[-1., 1.], palette=sns.color_palette(["tomato", "seagreen"]))
-sns.lineplot(data=pars5, x='previous_contrast', y='history_shift_corrected',
-             hue='previous_outcome', ax=ax[1], legend=False, estimator=np.median,
+sns.lineplot(data=pars5, x='prevcontrast', y='history_shift_corrected',
+             hue='prevfb', ax=ax[1], legend=False, estimator=np.median,
              err_style='bars', marker='o', hue_order=[-1., 1.],
              palette=sns.color_palette(["firebrick", "forestgreen"]))
 ax[1].axhline(color='grey')
@@ -215,4 +134,30 @@ fig.tight_layout()
 fig.savefig(os.path.join(figpath, "history_prevcontrast.png"))
 plt.close("all")
 
+# ================================= #
+# HISTORY KERNELS: LOGISTIC REGRESSION ON THE LAST TRIALS
+# ================================= #
+
+print('fitting history kernels...')
+trials = load_trials(os.path.join(datapath, 'ibl_trainingchoiceworld_clean'),
+                     columns=['subj_idx', 'eid', 'trialnum', 'signed_contrast', 'stimulus', 'response', 'feedbackType'])
+kernels = more_tools.fit_history_kernels(trials, n_lags=5)
+kernels = kernels[kernels.lag > 0]
+kernels['outcome'] = kernels.regressor.str.contains('correct').map({True: 'correct', False: 'error'})
+
+plt.close('all')
+fig, ax = plt.subplots(1, 1, figsize=[3.5, 3])
+sns.lineplot(data=kernels, x='lag', y='beta', hue='outcome', hue_order=['error', 'correct'],
+             units='subj_idx', estimator=None, alpha=0.2, linewidth=0.5, legend=False, ax=ax,
+             palette=sns.color_palette(["firebrick", "forestgreen"]))
+sns.lineplot(data=kernels, x='lag', y='beta', hue='outcome', hue_order=['error', 'correct'],
+             estimator=np.median, err_style='bars', marker='o', ax=ax,
+             palette=sns.color_palette(["firebrick", "forestgreen"]))
+ax.axhline(color='grey')
+ax.set(xlabel='Lag (trials back)', ylabel='Choice history weight', xticks=np.arange(1, 6))
+sns.despine(trim=True)
+fig.tight_layout()
+fig.savefig(os.path.join(figpath, "history_kernels.png"))
+plt.close("all")
+
 # %%
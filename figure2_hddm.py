@@ -18,8 +18,9 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 # more handy imports
-from utils_plot import results_long2wide_hddmnn, seaborn_style, corrfunc
+from utils_plot import load_hddm_results, seaborn_style, corrfunc
 import corrstats
+from utils_data import load_trials
 seaborn_style()
 
 # find path depending on location and dataset
@@ -72,14 +73,15 @@ fig.savefig(os.path.join(figpath, 'modelcomp_ddm_angle_weibull.png'))
 # COMPUTE HISTORY SHIFT AND CORRELATE WITH BEHAVIOR
 # ============================================ #
 
-data = pd.read_csv(os.path.join(datapath, 'ibl_trainingchoiceworld_clean.csv'))
+data = load_trials(os.path.join(datapath, 'ibl_trainingchoiceworld_clean'),
+                   columns=['subj_idx', 'response', 'prevresp', 'prevfb'])
 
-data['repeat'] = (data.response == data.prevresp)
-rep = data.groupby(['subj_idx', 'prevfb'])['repeat'].mean().reset_index()
+data['repeat'] = (data.response == data.prevresp).fillna(False).astype(bool) # missing responses do not count as repeats
+rep = data.groupby(['subj_idx', 'prevfb'], observed=True)['repeat'].mean().reset_index()
 rep = rep.pivot(index='subj_idx', columns='prevfb', values='repeat').reset_index()
 rep = rep.rename(columns={1.0: 'repeat_prevcorrect', -1.0: 'repeat_preverror'})
 # also add a measure of repetition without previous outcome
-rep2 = data.groupby(['subj_idx'])['repeat'].mean().reset_index()
+rep2 = data.groupby(['subj_idx'], observed=True)['repeat'].mean().reset_index()
 rep = pd.merge(rep, rep2, on='subj_idx')
 rep = rep.sort_values(by=['repeat'])
 
@@ -143,7 +145,7 @@ fig.savefig(os.path.join(figpath, 'modelcomp_%s.png'%mdl_type))
 # now load in the models we need
 # ============================================ #
 
-md_wide = results_long2wide_hddmnn(pd.read_csv(os.path.join(modelpath, mdl_type + '_prevresp_zv', 'results_combined.csv')))
+md_wide = load_hddm_results(os.path.join(modelpath, mdl_type + '_prevresp_zv', 'results_combined.csv'))
 
 # COMPUTE THE SAME THING FROM HDDM COLUMN NAMES
 # md_wide['dcshift'] = md_wide['dc']['1.0'] - md_wide['dc']['0.0']
@@ -11,118 +11,190 @@ Anne Urai, Leiden University, 2023
 # %%
 import pandas as pd
 import numpy as np
-import sys, os, time
+import sys, os, time, shutil
+from optparse import OptionParser
 import seaborn as sns
 import matplotlib.pyplot as plt
-from ibllib.io.extractors.training_wheel import extract_wheel_moves, extract_first_movement_times
-from brainbox.behavior.training import query_criterion
-from brainbox.io.one import load_wheel_reaction_times
 from tqdm import tqdm
 
 from one.api import ONE # use ONE instead of DJ! more future-proof
-
-one = ONE(base_url='https://openalyx.internationalbrainlab.org', password='international')
+import utils_get_data as data_tools
+import utils_choice_history as more_tools
+from utils_data import write_trials, remove_sessions
+
+# read inputs
+parser = OptionParser("get_data.py [options]")
+parser.add_option("-j", "--n_jobs",
+                  default=1,
+                  type="int",
+                  help="number of sessions to download at the same time")
+parser.add_option("-c", "--cache_size",
+                  default=2.,
+                  type="float",
+                  help="maximum size of the local trials cache (GB)")
+parser.add_option("-r", "--rebuild",
+                  action="store_true",
+                  default=False,
+                  help="ignore the manifest and rebuild the trial store from scratch")
+parser.add_option("-p", "--datapath",
+                  default='data',
+                  help="where to save the data")
+parser.add_option("-l", "--local",
+                  default=None,
+                  help="read from a fixture directory or offline snapshot (see utils_local_one.py) instead of the IBL server")
+parser.add_option("--latency",
+                  default=0.,
+                  type="float",
+                  help="with --local: seconds to wait for each request")
+parser.add_option("--failure_rate",
+                  default=0.,
+                  type="float",
+                  help="with --local: fraction of requests that fail")
+parser.add_option("-w", "--wheel_rt",
+                  action="store_true",
+                  default=False,
+                  help="compute first movement times from the raw wheel traces, in batches of sessions")
+parser.add_option("-b", "--batch_size",
+                  default=20,
+                  type="int",
+                  help="with --wheel_rt: number of sessions to process at once")
+parser.add_option("-s", "--stream",
+                  action="store_true",
+                  default=False,
+                  help="also preprocess each session as it comes in, add it to the clean trial store and update the history metrics of its mouse")
+parser.add_option("-m", "--mode",
+                  default='trained',
+                  help="'trained': the 3 sessions up to trained_1a per mouse; 'all': every session of --protocol")
+parser.add_option("--protocol",
+                  default=None,
+                  help="task protocol to select (regular expression, e.g. 'biased|ephys'); "
+                       "default trainingChoiceWorld with --mode trained, any ChoiceWorld with --mode all")
+parser.add_option("--date_range",
+                  default=None,
+                  help="with --mode all: only sessions between these dates, e.g. 2019-01-01:2020-12-31")
+parser.add_option("-n", "--name",
+                  default=None,
+                  help="name of the trial stores and manifest (default ibl_trainingchoiceworld or ibl_allsessions)")
+opts, args = parser.parse_args()
+if opts.protocol is None:
+    opts.protocol = 'trainingChoiceWorld' if opts.mode == 'trained' else 'ChoiceWorld'
+if opts.name is None:
+    opts.name = 'ibl_trainingchoiceworld' if opts.mode == 'trained' else 'ibl_allsessions'
+
+if opts.local is not None:
+    from utils_local_one import LocalONE
+    one = LocalONE(opts.local, latency=opts.latency, failure_rate=opts.failure_rate)
+else:
+    one = ONE(base_url='https://openalyx.internationalbrainlab.org', password='international')
 
 # define path to save the data and figures
-datapath = 'data'
+datapath = opts.datapath
+
+# keep the trials objects we load on disk, so that we never load the same session twice
+trial_cache = data_tools.TrialCache(os.path.join(datapath, 'trials_cache'), max_size=opts.cache_size * 1e9)
+
+# the manifest keeps track of which sessions are already in the trial store, so that re-runs only add new ones
+raw_file = os.path.join(datapath, opts.name + '_raw') # Parquet store, one folder per lab and subject
+clean_file = os.path.join(datapath, opts.name + '_clean') # with --stream
+metrics_file = os.path.join(datapath, opts.name + '_history_metrics.csv') # with --stream
+manifest_file = os.path.join(datapath, opts.name + '_manifest.csv')
+if opts.rebuild:
+    if os.path.exists(raw_file): shutil.rmtree(raw_file)
+    if opts.stream and os.path.exists(clean_file): shutil.rmtree(clean_file)
+    if opts.stream and os.path.exists(metrics_file): os.remove(metrics_file)
+    if os.path.exists(manifest_file): os.remove(manifest_file)
+manifest = data_tools.SessionManifest(manifest_file)
+if opts.stream: metrics = more_tools.HistoryMetrics(metrics_file) # running choice history metrics per mouse
 
 #%% 0. GET LIST OF ALL POTENTIAL SUBJECTS 
 # find the full cache with subjects + protocols (but not training status)
 cache_df = pd.DataFrame(one._cache.sessions).reindex().sort_values(by=['projects', 'lab', 'subject', 'date'])
 # cache_df = cache_df[cache_df['projects'] == 'ibl_neuropixel_brainwide_01']
 
+#%% 1a. WHOLE DATABASE: EVERY SESSION OF THIS PROTOCOL
+if opts.mode == 'all':
+    date_range = opts.date_range.split(':') if opts.date_range is not None else None
+    selected = data_tools.select_all_sessions(cache_df, protocol=opts.protocol, date_range=date_range)
+    manifest.select(selected['subject'], selected['id']) # only adds sessions that are new since the last run
+    print('%d mice, %d sessions'%(selected['subject'].nunique(), len(selected)))
+
+#%% 1b. QUERY SESSIONS
 # find subjects through Alyx REST -- only those subjects who made it to biased
-subjects = one.alyx.rest('sessions', 'list', 
-    # tag='2021_Q1_IBL_et_al_Behaviour',
-    dataset_types='trials.table',
-    task_protocol='biased')
-subject_names = np.unique([s['subject'] for s in subjects])
-print(len(subject_names))
-
-#%% 1. QUERY SESSIONS
-# on which day did these animals reach biasedCW? get these eids
-eids_to_use = []
-for subject in tqdm(subject_names):
-
-    # first find the day when trained_1a was reached
-    try: eid, n_sessions, n_days = query_criterion(subject, 'trained_1a')  
-    except: print('cannot retrieve training status for %s'%subject); continue  # if some animals don't allow criterion query, skip for now
-    
-    # no trained_1a? some animals may have gone straight to trained_1b
-    if eid is None: eid, n_sessions, n_days = query_criterion(subject, 'trained_1b') 
-    if eid is None: print('no trained_1a or trained_1b found for %s'%subject); continue
-
-    # now find the 3 days before this
-    # find the 3 sessions before n_sessions (when trained_1a was reached)
-    cache_sj = cache_df[cache_df['subject'] == subject].reset_index()
-    three_sessions_before_trained1a = cache_sj.iloc[n_sessions-3:n_sessions, :]
-
-    # assert that all of these have the task protocol including trainingchoiceworld
-    if not (all(three_sessions_before_trained1a['task_protocol'].str.contains('trainingChoiceWorld'))): \
-        print('not all sessions have trainingChoiceWorld for %s'%subject); \
-            print(three_sessions_before_trained1a); continue
-
-    # assert that this returns 3 sessions per mouse
-    if not (len(three_sessions_before_trained1a)) == 3: print('not 3 sessions for %s'%subject); continue
-
-    # also double check that for each of those sessions, trials can be loaded
-    add_to_list = True
-    for eid_to_check in three_sessions_before_trained1a['id'].tolist():
-        try: trials_obj = one.load_object(eid_to_check, 'trials')
-        except: add_to_list = False; print('could not load trials for %s'%subject); continue
-    if not add_to_list: continue
-
-    #print('adding sessions for %s'%subject)
-    for eid in three_sessions_before_trained1a['id'].tolist():
-        eids_to_use.append(eid) # append
-
-# PRINT number of sessions
-assert(len(eids_to_use) % 3 == 0) # there should be 3 sessions per mouse
-print('%d sessions'%(len(eids_to_use)))
+else:
+    subjects = one.alyx.rest('sessions', 'list',
+        # tag='2021_Q1_IBL_et_al_Behaviour',
+        dataset_types='trials.table',
+        task_protocol='biased')
+    subject_names = np.unique([s['subject'] for s in subjects])
+    print(len(subject_names))
+
+    # on which day did these animals reach biasedCW? get these eids
+    # subjects that are already in the manifest have their sessions selected, skip them
+    subject_names = [s for s in subject_names if s not in manifest.subjects()]
+
+    # first find the session when trained_1a was reached - some animals may have gone straight to trained_1b
+    status = data_tools.query_training_status(one, subject_names, cache_df,
+                                              criteria=['trained_1a', 'trained_1b'], n_jobs=opts.n_jobs)
+
+    # now find the 3 sessions before trained_1a was reached, for all subjects at once
+    # and assert that all of these have the task protocol including trainingchoiceworld
+    selected = data_tools.select_sessions(cache_df, status, n_sessions=3, protocol=opts.protocol)
+
+    # also double check that for each of those sessions, trials can be loaded (this fills the cache for step 2)
+    failed = data_tools.check_sessions(one, selected['id'].tolist(), cache=trial_cache, n_jobs=opts.n_jobs)
+    for subject in selected.loc[selected['id'].isin(failed), 'subject'].unique():
+        print('could not load trials for %s'%subject)
+    selected = selected[~selected['subject'].isin(selected.loc[selected['id'].isin(failed), 'subject'])]
+
+    manifest.select(selected['subject'], selected['id'])
+
+    # PRINT number of sessions
+    eids_to_use = manifest.eids()
+    assert(len(eids_to_use) % 3 == 0) # there should be 3 sessions per mouse
+    print('%d sessions'%(len(eids_to_use)))
 
 # %% 2. LOAD TRIALS
-behav = []
-for eid in tqdm(eids_to_use): # dont use all for now...
-
-    trials_obj = one.load_object(eid, 'trials')
-    trials_obj['signed_contrast'] = 100 * np.diff(np.nan_to_num(np.c_[trials_obj['contrastLeft'], 
-                                                        trials_obj['contrastRight']]))
-    
-    # use a very crude measure of RT: trial duration 
-    trials_obj['trial_duration'] = trials_obj['response_times'] - trials_obj['goCue_times']
-
-    trials = trials_obj.to_df() # to dataframe
-    trials['trialnum'] = trials.index # to keep track of choice history
-    trials['response'] = trials['choice'].map({1: 0, 0: np.nan, -1: 1})
-
-    # better way to define RT: based on wheelMoves, Miles' code from Brainbox
-    try: trials['firstmove_time'] = load_wheel_reaction_times(eid)
-        # # also: was this movement the final one?
-        # TODO: ask Miles why the public database does not contain wheel data for these training sessions?
-        # # https://int-brain-lab.github.io/iblenv/notebooks_external/docs_wheel_moves.html#Finding-reaction-time-and-'determined'-movements
-        # wheel = one.load_object(eid, 'wheel')
-        # moves = extract_wheel_moves(wheel['timestamps'], wheel['position'])
-        # assert moves, 'unable to load trials and wheelMoves data'
-        # trials['firstmove_time_wheel'], trials['wheel_is_final_movement'], ids \
-        #     = extract_first_movement_times(moves, trials_obj)
-    except: print('skipping %s, no RTs'%eid); continue
-
-    # retrieve the mouse name, session etc
-    ref_dict = one.eid2ref(eid)
-    trials['eid'] = eid
-    trials['subj_idx'] = ref_dict.subject
-    trials['date'] = ref_dict.date
-    behav.append(trials)
-
-# continue only with some columns we need
-df = pd.concat(behav)
-df = df[['eid', 'subj_idx', 'date', 'signed_contrast', 
-         'response', 'trial_duration', 'firstmove_time','feedbackType', 'trialnum']]
-
-# %% 4. REFORMAT AND SAVE TRIALS
-df.to_csv(os.path.join(datapath, 'ibl_trainingchoiceworld_raw.csv'))
-print(os.path.join(datapath, 'ibl_trainingchoiceworld_raw.csv'))
-print('%d mice, %d trials'%(df.subj_idx.nunique(),  df.subj_idx.count()))
-
-# %%
-df.describe()
\ No newline at end of file
+# sessions that were fetched but not marked as written may be half in the store after a crash, remove them
+remove_sessions(raw_file, manifest.eids('fetched'))
+if opts.stream: remove_sessions(clean_file, manifest.eids('fetched'))
+
+# only load what is not in the store yet; keep opts.n_jobs sessions in flight
+eids_todo = manifest.todo()
+print('%d sessions left to load'%len(eids_todo))
+progress = data_tools.PartitionProgress(cache_df.loc[eids_todo, 'lab'] + '/' + cache_df.loc[eids_todo, 'subject'])
+sessions = data_tools.fetch_sessions(one, eids_todo, n_jobs=opts.n_jobs, cache=trial_cache, wheel_rt=opts.wheel_rt)
+if opts.wheel_rt: # first movement times for batch_size sessions at a time
+    sessions = data_tools.add_wheel_reaction_times(one, sessions, batch_size=opts.batch_size, n_jobs=opts.n_jobs)
+for eid, trials in sessions:
+    if trials is None: manifest.set_status(eid, 'failed'); progress.update(eid); continue
+    manifest.set_status(eid, 'fetched')
+
+    # 4. REFORMAT AND SAVE TRIALS
+    # continue only with some columns we need, and append this session to the store
+    trials['lab'] = cache_df.loc[eid, 'lab']
+    trials = trials[['eid', 'lab', 'subj_idx', 'date', 'signed_contrast',
+                     'response', 'trial_duration', 'firstmove_time','feedbackType', 'trialnum']]
+    write_trials(trials, raw_file, append=True)
+
+    # preprocess this session straight away, while the next ones are downloading
+    status = 'written'
+    if opts.stream:
+        try:
+            clean = more_tools.preprocess_session(trials.copy())
+            write_trials(clean, clean_file, append=True)
+            metrics.update(clean) # sessions that are in already (e.g. after a crash) are skipped
+        except AssertionError:
+            print('not preprocessing %s, RTs out of bounds'%eid)
+            status = 'raw_only' # in the raw store, but not in the clean store or the history metrics
+    manifest.set_status(eid, status, ntrials=len(trials))
+    progress.update(eid, ntrials=len(trials))
+
+print(raw_file)
+written = manifest.sessions[manifest.sessions['status'].isin(['written', 'raw_only'])]
+print('%d mice, %d trials'%(written.subject.nunique(), written.ntrials.sum()))
+if len(manifest.eids('raw_only')):
+    print('%d sessions are only in the raw store, their RTs are out of bounds: %s'%(len(manifest.eids('raw_only')),
+                                                                                    ', '.join(manifest.eids('raw_only'))))
+print('%d sessions failed, these will be retried on the next run'%len(manifest.eids('failed')))
+progress.summary().to_csv(os.path.join(datapath, opts.name + '_progress.csv'), index_label='partition')
+if opts.stream: print(metrics.metrics(fit=False).describe().round(3))
\ No newline at end of file
@@ -0,0 +1,187 @@
+"""
+render all figures headless (Agg backend), with the figure scripts running in parallel
+
+python make_figures.py -j 8 # preprocess_data.py first (it writes the clean trials), then all figure scripts at once
+only scripts whose inputs (data, model fits, code or arguments) changed since their last successful run are run again;
+-a runs them all
+"""
+
+# ============================================ #
+# GETTING STARTED
+# ============================================ #
+
+from optparse import OptionParser
+import pandas as pd
+import os, sys, time, runpy, glob, json, hashlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ['MPLBACKEND'] = 'Agg' # no display needed, also in the worker processes
+os.environ['FIGURE_N_JOBS'] = '1' # the scripts run in parallel already, they should not each start a process pool
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from utils_data import preload_trials
+
+figure_scripts = ['figure1a_plot_behavior.py', 'figure1b_choice_history.py', 'figure1c_history_strategy.py',
+                  'figure2_hddm.py', 'plot_contrast_rescale.py']
+
+# read inputs
+parser = OptionParser("make_figures.py [options]")
+parser.add_option("-j", "--n_jobs",
+                  default=os.cpu_count(),
+                  type="int",
+                  help="number of figure scripts to run at the same time (default: all cores)")
+parser.add_option("-f", "--figures",
+                  default=','.join(figure_scripts),
+                  help="comma-separated list of figure scripts to run")
+parser.add_option("--no_preprocess",
+                  action="store_true",
+                  default=False,
+                  help="do not run preprocess_data.py (and its plots) first, use the clean trials that are there")
+parser.add_option("-a", "--all",
+                  action="store_true",
+                  default=False,
+                  help="run every script, also those whose inputs did not change")
+parser.add_option("-m", "--modelpath",
+                  default='/home/uraiae/data1/HDDMnn/ibl_trainingchoiceworld_clean',
+                  help="where the HDDM fits are that figure2_hddm.py and plot_contrast_rescale.py read")
+parser.add_option("--bootstrap",
+                  action="store_true",
+                  default=False,
+                  help="run figure1c_history_strategy.py with --bootstrap")
+opts, args = parser.parse_args()
+
+# like the figure scripts, run from the folder with data/ and figures/
+datapath = 'data'
+figpath = 'figures'
+scriptpath = os.path.dirname(os.path.realpath(__file__))
+clean_file = os.path.join(datapath, 'ibl_trainingchoiceworld_clean')
+
+# what each script reads: data (glob patterns, relative to here), code (next to this file) and arguments.
+# the psychometric fit cache is left out, the scripts add to it themselves
+inputs = {'preprocess_data.py': {'data': [os.path.join(datapath, 'ibl_trainingchoiceworld_raw')],
+                                 'code': ['utils_choice_history.py', 'utils_data.py', 'utils_plot.py']},
+          'figure1a_plot_behavior.py': {'data': [clean_file],
+                                        'code': ['utils_choice_history.py', 'utils_data.py', 'utils_plot.py']},
+          'figure1b_choice_history.py': {'data': [clean_file],
+                                         'code': ['utils_choice_history.py', 'utils_data.py', 'utils_plot.py']},
+          'figure1c_history_strategy.py': {'data': [clean_file],
+                                           'code': ['utils_choice_history.py', 'utils_data.py', 'utils_plot.py'],
+                                           'args': ['--bootstrap'] if opts.bootstrap else []},
+          'figure2_hddm.py': {'data': [clean_file, os.path.join(opts.modelpath, '*', 'model_comparison.csv'),
+                                       os.path.join(opts.modelpath, '*', 'results_combined.csv')],
+                              'code': ['utils_data.py', 'utils_plot.py', 'corrstats.py']},
+          'plot_contrast_rescale.py': {'data': [os.path.join(opts.modelpath, 'ddm_nohist_stimcat', 'results_combined.csv')],
+                                       'code': ['utils_plot.py']}}
+hash_file = os.path.join(figpath, 'make_figures_hashes.json')
+
+
+def file_hash(path, known):
+    """
+    sha1 of the contents of a file, or of all files in a directory (e.g. a Parquet store, whatever their names).
+    known holds earlier hashes by path, size and modification time, so that unchanged files are not read again
+    """
+    if os.path.isdir(path):
+        files = sorted(glob.glob(os.path.join(path, '**', '*'), recursive=True))
+        hashes = sorted(file_hash(f, known) for f in files if os.path.isfile(f))
+        return hashlib.sha1(''.join(hashes).encode()).hexdigest()
+
+    stat = os.stat(path)
+    if path in known and known[path][:2] == [stat.st_size, stat.st_mtime_ns]:
+        return known[path][2]
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    known[path] = [stat.st_size, stat.st_mtime_ns, sha1.hexdigest()]
+    return known[path][2]
+
+
+def input_hash(script, known):
+    """
+    One hash over everything a script reads: the script itself, its data, its code and its arguments
+    """
+    deps = inputs.get(script, {})
+    paths = [os.path.join(scriptpath, script)] + [os.path.join(scriptpath, c) for c in deps.get('code', [])]
+    for pattern in deps.get('data', []):
+        paths += sorted(glob.glob(pattern)) or [pattern] # an input that is not there yet is still part of the hash
+    hashes = [p + ':' + (file_hash(p, known) if os.path.exists(p) else 'missing') for p in paths]
+    return hashlib.sha1('\n'.join(hashes + deps.get('args', [])).encode()).hexdigest()
+
+
+def run_figure(script):
+    """
+    Run one figure script, return its wall time (s) and whether it finished
+    """
+    sys.argv = [script] + inputs.get(script, {}).get('args', [])
+    t0 = time.time()
+    try:
+        runpy.run_path(os.path.join(scriptpath, script), run_name='__main__')
+        status = 'ok'
+    except SystemExit as e:
+        status = 'ok' if e.code in (None, 0) else 'exit %s'%e.code
+    except Exception as e: # e.g. no HDDM fits yet for figure2_hddm.py, the other figures still get made
+        status = '%s: %s'%(type(e).__name__, e)
+    plt.close('all')
+    return {'script': script, 'seconds': time.time() - t0, 'status': status}
+
+# ============================================ #
+# RUN THE FIGURE SCRIPTS
+# ============================================ #
+
+if __name__ == '__main__':
+
+    if not os.path.exists(figpath):
+        os.mkdir(figpath)
+
+    # hashes of the inputs of each script at its last successful run
+    if os.path.exists(hash_file):
+        with open(hash_file) as f:
+            state = json.load(f)
+    else:
+        state = {'files': {}, 'figures': {}}
+
+    def save_state():
+        with open(hash_file + '.tmp', 'w') as f:
+            json.dump(state, f, indent=1)
+        os.replace(hash_file + '.tmp', hash_file)
+
+    def todo(scripts):
+        hashes = {s: input_hash(s, state['files']) for s in scripts}
+        for s in scripts:
+            if not opts.all and state['figures'].get(s) == hashes[s]:
+                print('%s: inputs unchanged, skipping'%s)
+        return {s: h for s, h in hashes.items() if opts.all or state['figures'].get(s) != h}
+
+    def record(result, hashes):
+        print('%(script)s: %(seconds).1f s, %(status)s'%result)
+        if result['status'] == 'ok': # failed scripts are run again next time
+            state['figures'][result['script']] = hashes[result['script']]
+            save_state()
+
+    t0 = time.time()
+    results = []
+
+    # 1. preprocess_data.py writes the clean trials that the figure scripts read, so it goes first
+    if not opts.no_preprocess:
+        hashes = todo(['preprocess_data.py'])
+        if hashes:
+            results.append(run_figure('preprocess_data.py'))
+            record(results[-1], hashes)
+
+    # 2. read the clean trials once; forked workers share them with this process
+    hashes = todo(opts.figures.split(','))
+    if hashes:
+        preload_trials(clean_file)
+        with ProcessPoolExecutor(max_workers=max(opts.n_jobs, 1), mp_context=mp.get_context('fork')) as pool:
+            for result in pool.map(run_figure, list(hashes)):
+                results.append(result)
+                record(result, hashes)
+
+    if results:
+        results = pd.DataFrame(results)
+        print(results.to_string(index=False, float_format='%.1f'))
+        results.to_csv(os.path.join(figpath, 'make_figures_timing.csv'), index=False)
+    print('%d figure scripts run in %.1f s'%(len(results), time.time() - t0))
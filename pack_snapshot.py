@@ -0,0 +1,62 @@
+"""
+pack all data that get_data.py needs into one offline snapshot, for cluster nodes without internet access
+
+afterwards, on the cluster: python get_data.py --local data/ibl_snapshot_YYYYMMDD.zip
+"""
+
+# ============================================ #
+# GETTING STARTED
+# ============================================ #
+
+from optparse import OptionParser
+import pandas as pd
+import os
+
+import utils_get_data as data_tools
+from utils_local_one import pack_snapshot
+
+# read inputs
+parser = OptionParser("pack_snapshot.py [options]")
+parser.add_option("-p", "--datapath",
+                  default='data',
+                  help="where the manifest of get_data.py is")
+parser.add_option("-o", "--output",
+                  default=None,
+                  help="snapshot file (default: datapath/ibl_snapshot_YYYYMMDD.zip)")
+parser.add_option("-j", "--n_jobs",
+                  default=1,
+                  type="int",
+                  help="number of sessions to download at the same time")
+parser.add_option("-n", "--name",
+                  default='ibl_trainingchoiceworld',
+                  help="name of the manifest of get_data.py (ibl_allsessions with get_data.py --mode all)")
+parser.add_option("-l", "--local",
+                  default=None,
+                  help="pack from a fixture directory (see utils_local_one.py) instead of the IBL server")
+opts, args = parser.parse_args()
+
+if opts.local is not None:
+    from utils_local_one import LocalONE
+    one = LocalONE(opts.local)
+else:
+    from one.api import ONE
+    one = ONE(base_url='https://openalyx.internationalbrainlab.org', password='international')
+
+output = opts.output or os.path.join(opts.datapath, 'ibl_snapshot_%s.zip'%pd.Timestamp.now().strftime('%Y%m%d'))
+
+# ============================================ #
+# PACK THE SESSIONS FROM THE MANIFEST
+# ============================================ #
+
+# run get_data.py first: its manifest holds the subjects and sessions we use
+manifest = data_tools.SessionManifest(os.path.join(opts.datapath, opts.name + '_manifest.csv'))
+eids = manifest.eids()
+subjects = sorted(manifest.subjects())
+print('%d mice, %d sessions'%(len(subjects), len(eids)))
+
+# training status of these mice, so that session selection works the same offline
+status = data_tools.query_training_status(one, subjects, one._cache.sessions,
+                                          criteria=['trained_1a', 'trained_1b'], n_jobs=opts.n_jobs)
+
+pack_snapshot(one, eids, status, output, objects=['trials', 'wheel', 'wheelMoves'], n_jobs=opts.n_jobs)
+print(output)
@@ -21,7 +21,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 # more handy imports
-from utils_plot import results_long2wide_hddmnn, seaborn_style
+from utils_plot import load_hddm_results, seaborn_style
 seaborn_style()
 
 # find path depending on location and dataset
@@ -35,7 +35,7 @@ datapath = 'data'
 # sanity check, drift rate by contrast
 # ============================================ #
 
-md = results_long2wide_hddmnn(pd.read_csv(os.path.join(modelpath, 'ddm_nohist_stimcat', 'results_combined.csv')))
+md = load_hddm_results(os.path.join(modelpath, 'ddm_nohist_stimcat', 'results_combined.csv'))
 md.columns = md.columns.map(''.join)
 md.rename(columns={'v-100.0':-100., 'v-50.0':-50., 'v-25.0':-25., 'v-12.5':-12.5, 'v-6.25':-6.25, 'v0.0':0.,
                                             'v6.25':6.25, 'v12.5':12.5, 'v25.0':25., 'v50.0':50., 'v100.0':100.},
@@ -13,52 +13,69 @@ import seaborn as sns
 import brainbox as bb
 import utils_plot as tools
 import utils_choice_history as more_tools
+from utils_data import load_trials, write_trials, memory_report
 
 datapath = 'data'
 figpath = 'figures'
 tools.seaborn_style()
 
-# set some thresholds
+# set some thresholds - get_data.py --stream uses the defaults of more_tools.preprocess_session
 rt_variable_name = 'trial_duration' # trial_duration or firstmove_time... decide
 rt_cutoff = [0.120, 2] # 80ms, 2s - from BWM paper
+n_lags = 1 # previous/next trials to add history columns for: prevresp, prevresp2, ... and nextresp, nextresp2, ...
+
+# python preprocess_data.py --sweep: only test how much these choices matter, for all combinations of these
+sweep = '--sweep' in sys.argv
+sweep_rt_variables = ['trial_duration', 'firstmove_time']
+sweep_lower = [0.08, 0.1, 0.12, 0.15, 0.2]
+sweep_upper = [1, 1.5, 2, 3, 5]
 
 # %% ================================= #
 
-data = pd.read_csv(os.path.join(datapath, 'ibl_trainingchoiceworld_raw.csv'))
+data = load_trials(os.path.join(datapath, 'ibl_trainingchoiceworld_raw'))
+# sessions are appended to the store as they come in, put trials back in order
+data = data.sort_values(by=['subj_idx', 'date', 'eid', 'trialnum']).reset_index(drop=True)
 
-# remove RTs that sit outside the cutoff window
-# define how we quantify RTs
-data['rt_raw'] = data[rt_variable_name].copy()
-data['rt'] = more_tools.clean_rts(data[rt_variable_name], cutoff=rt_cutoff, 
-                                  compare_with=None)
+if sweep:
+    # retained trials and RT summaries for every RT definition and cutoff, saved in one file
+    masks, summary = more_tools.rt_cutoff_sweep(data, rt_variables=sweep_rt_variables,
+                                                lower=sweep_lower, upper=sweep_upper)
+    more_tools.save_rt_sweep(os.path.join(datapath, 'ibl_trainingchoiceworld_rt_sweep.npz'), data, masks, summary,
+                             sweep_rt_variables, sweep_lower, sweep_upper)
+    print(summary[summary['subj_idx'] == 'all'].to_string(index=False, float_format='%.3f'))
+    sys.exit()
 
-# add choice history information
-data_clean = more_tools.compute_choice_history(data)
+# remove RTs that sit outside the cutoff window, add choice history information
+# and rescale contrast, so that we can enter as a linear term for the drift rate
+data_clean = more_tools.preprocess_session(data, rt_variable_name=rt_variable_name, rt_cutoff=rt_cutoff,
+                                           n_lags=n_lags)
 
-# rescale contrast, so that we can enter as a linear term for the drift rate
-data_clean['stimulus'] = more_tools.rescale_contrast(data_clean['signed_contrast'])
+print(memory_report(data_clean).to_string(float_format='%.2f'))
 
-# save to csv   
+# save to the trial store, and to csv for the HDDM environment (which does not have pyarrow)
+write_trials(data_clean, os.path.join(datapath, 'ibl_trainingchoiceworld_clean'))
 data_clean.to_csv(os.path.join(datapath, 'ibl_trainingchoiceworld_clean.csv'), index=False)
 
 # %% ================================= #
 # DISTRIBUTION OF RESULTING RTS
 
-data['rt_raw'] = data[rt_variable_name].copy()
+# plot the raw RTs, without adding another copy of them to the data
+rt_raw = data_clean[['subj_idx']].copy()
+rt_raw['rt_raw'] = data_clean[rt_variable_name]
 
 # make strings for bin labels based on rt_cutoff values
 bin_labels = ['< %dms'%int(rt_cutoff[0]*1000), 
               '%dms - %ds'%(int(rt_cutoff[0]*1000), int(rt_cutoff[1])), 
               '> %ds'%int(rt_cutoff[1])]
-data_clean['rt_raw_category'] = pd.cut(data['rt_raw'], 
-                                       bins=[data.rt_raw.min(), rt_cutoff[0], rt_cutoff[1], data.rt_raw.max()],
-                                       labels=bin_labels, right=True)
+rt_raw['rt_raw_category'] = pd.cut(rt_raw['rt_raw'], 
+                                   bins=[rt_raw.rt_raw.min(), rt_cutoff[0], rt_cutoff[1], rt_raw.rt_raw.max()],
+                                   labels=bin_labels, right=True)
 
 # squash for easier plotting - to show all slow trials as 1 bin 
-data_clean.rt_raw[data_clean.rt_raw > rt_cutoff[1]] = rt_cutoff[1] 
+rt_raw.loc[rt_raw.rt_raw > rt_cutoff[1], 'rt_raw'] = rt_cutoff[1] 
 
 # use FacetGrid to ensure the same figure size (approximately)
-fig = sns.FacetGrid(data=data_clean, hue='rt_raw_category',
+fig = sns.FacetGrid(data=rt_raw, hue='rt_raw_category',
                   palette=['lightgrey', 'darkblue', 'lightgrey'])
 fig.map(sns.histplot, "rt_raw", multiple='stack', legend=False, binwidth=0.06)
 
@@ -74,8 +91,8 @@ for axidx, ax in enumerate(fig.axes.flat):
 sns.despine(trim=True)
 
 # annotate: how many trials are below the lower cutoff, and how many are above the higher cutoff?
-percent_below = (data_clean.rt_raw < rt_cutoff[0]).mean() * 100
-percent_above = (data_clean.rt_raw >= rt_cutoff[1]).mean() * 100
+percent_below = (rt_raw.rt_raw < rt_cutoff[0]).mean() * 100
+percent_above = (rt_raw.rt_raw >= rt_cutoff[1]).mean() * 100
 plt.annotate('%d%%'%percent_below, xy=(rt_cutoff[0]/2, 2000), ha='center', fontsize=7)
 plt.annotate('%d%%'%percent_above, xy=(rt_cutoff[1]-0.1, 3000), ha='center', fontsize=7)
 
@@ -84,7 +101,7 @@ plt.savefig(os.path.join(figpath, "rt_raw_distributions.pdf"))
 
 #%% now plot the same, but one panel per mouse
 plt.savefig(os.path.join(figpath, "rt_raw_distributions_allsj.png"))
-fig = sns.FacetGrid(data=data_clean, col='subj_idx', hue='rt_raw_category', 
+fig = sns.FacetGrid(data=rt_raw, col='subj_idx', hue='rt_raw_category', 
                     palette=['lightgrey', 'darkblue', 'lightgrey'],
                     col_wrap=6, sharex=True, sharey=False)
 fig.map(sns.histplot, 'rt_raw', binwidth=0.075)
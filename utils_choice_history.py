@@ -1,25 +1,42 @@
    
 import pandas as pd
 import numpy as np
+import os
+from utils_data import apply_dtypes
    
-def compute_choice_history(trials):
+def compute_choice_history(trials, n_lags=1, group='eid'):
+    """
+    Add the response, feedback and absolute contrast of the n_lags previous trials (prevresp, prevfb, prevcontrast
+    for lag 1, prevresp2 etc. for lag 2 and up) and of the n_lags next trials (nextresp etc., for correction a la Lak et al.).
+    All lags are computed on the arrays at once; a lag is missing (nan) when it crosses into another session (group),
+    or when the trials in between are not consecutive based on trialnum.
+    """
 
     print('adding choice history columns to database...')
 
-    # append choice history 
-    trials['prevresp']      = trials.response.shift(1)
-    trials['prevfb']        = trials.feedbackType.shift(1)
-    trials['prevcontrast']  = np.abs(trials.signed_contrast.shift(1))
+    # numeric arrays, with nan for missing responses
+    values = {'resp': trials.response.to_numpy(dtype=float, na_value=np.nan),
+              'fb': trials.feedbackType.to_numpy(dtype=float, na_value=np.nan),
+              'contrast': np.abs(trials.signed_contrast.to_numpy(dtype=float, na_value=np.nan))}
+    session = pd.factorize(trials[group])[0] if group in trials.columns else np.zeros(len(trials), dtype=int)
+    trialnum = trials.trialnum.to_numpy(dtype=float, na_value=np.nan)
+    n = len(trials)
 
-    # also append choice future (for correction a la Lak et al.)
-    trials['nextresp']      = trials.response.shift(-1)
-    trials['nextfb']        = trials.feedbackType.shift(-1)
-    trials['nextcontrast']  = np.abs(trials.signed_contrast.shift(-1))
+    for lag in range(1, n_lags + 1):
+        suffix = '' if lag == 1 else str(lag)
+        k = min(lag, n)
 
-    # remove when not consecutive based on trial_index
-    trials_not_consecutive       = (trials.trialnum - trials.trialnum.shift(1)) != 1.
-    for col in ['prevresp', 'prevfb', 'prevcontrast']:
-        trials.loc[trials_not_consecutive, col] = np.nan
+        # trial i has a previous trial at lag when i - lag is in the same session, exactly lag trials before
+        valid = (session[k:] == session[:n - k]) & (trialnum[k:] - trialnum[:n - k] == lag)
+        for name, x in values.items():
+            prev = np.full(n, np.nan)
+            prev[k:] = np.where(valid, x[:n - k], np.nan)
+            trials['prev' + name + suffix] = prev
+
+            # and the same mask, the other way around, for the next trials
+            nxt = np.full(n, np.nan)
+            nxt[:n - k] = np.where(valid, x[k:], np.nan)
+            trials['next' + name + suffix] = nxt
 
     return trials
 
@@ -53,4 +70,234 @@ def rescale_contrast(x):
     a = 2.13731484
     b = 0.05322221
     
-    return a * np.tanh( b * x )
\ No newline at end of file
+    return a * np.tanh( b * x )
+
+def preprocess_session(trials, rt_variable_name='trial_duration', rt_cutoff=[0.120, 2], n_lags=1):
+    """
+    All preprocessing steps of preprocess_data.py: clean RTs, add choice history and rescale contrast.
+    Works on the full dataset, or on one session at a time as it comes in (see get_data.py --stream)
+    """
+
+    # remove RTs that sit outside the cutoff window (the raw RTs stay in trials[rt_variable_name])
+    trials['rt'] = clean_rts(trials[rt_variable_name], cutoff=rt_cutoff,
+                             compare_with=None)
+
+    # add choice history information
+    trials = compute_choice_history(trials, n_lags=n_lags)
+
+    # rescale contrast, so that we can enter as a linear term for the drift rate
+    trials['stimulus'] = rescale_contrast(trials['signed_contrast'])
+
+    # keep the table compact: nullable int8 for the history columns, float32 for RTs
+    return apply_dtypes(trials)
+
+def rt_cutoff_sweep(trials, rt_variables=['trial_duration', 'firstmove_time'],
+                    lower=[0.08, 0.1, 0.12, 0.15, 0.2], upper=[1, 1.5, 2, 3, 5]):
+    """
+    Apply every combination of RT definition (rt_variables) and cutoff window [lower, upper] to the trials at once,
+    as clean_rts does for one of them.
+
+    Returns a boolean array of retained trials with shape (rt_variables, lower, upper, trials), in the order of trials,
+    and a table with, for each variant and subject (subj_idx 'all' for all subjects together), the number and fraction
+    of retained trials and their mean and median RT.
+    """
+
+    lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+    rts = np.stack([trials[v].to_numpy(dtype=float, na_value=np.nan) for v in rt_variables])
+    masks = (rts[:, None, None, :] >= lower[None, :, None, None]) & (rts[:, None, None, :] <= upper[None, None, :, None])
+
+    # summary statistics: sort the RTs of each subject once, then each cutoff window is a contiguous slice
+    subj_codes, subjects = pd.factorize(trials['subj_idx'], sort=True)
+    groups = np.concatenate([subj_codes, np.full(len(trials), len(subjects))]) # the second copy is for all subjects
+    subjects = np.append(np.asarray(subjects, dtype=str), 'all')
+
+    summary = []
+    for v, rt in enumerate(rts):
+        rt = np.concatenate([rt, rt])
+        keep = ~np.isnan(rt)
+        offset = np.nanmax(np.abs(rt)) * 2 + max(np.abs(lower).max(), np.abs(upper).max()) + 1
+        key = np.sort(groups[keep] * offset + rt[keep]) # subject blocks of sorted RTs
+        csum = np.append(0, np.cumsum(key - np.sort(groups[keep]) * offset))
+
+        g = np.arange(len(subjects))[:, None, None]
+        start = np.searchsorted(key, g * offset + lower[None, :, None], side='left')
+        stop = np.searchsorted(key, g * offset + upper[None, None, :], side='right')
+        n_retained = np.maximum(stop - start, 0)
+        mid = start + np.maximum(n_retained - 1, 0) / 2 # median: halfway along the slice
+        median = (key[np.clip(np.floor(mid).astype(int), 0, len(key) - 1)] +
+                  key[np.clip(np.ceil(mid).astype(int), 0, len(key) - 1)]) / 2 - g * offset
+        mean = (csum[np.maximum(stop, start)] - csum[start]) / np.where(n_retained > 0, n_retained, np.nan)
+        n_trials = np.bincount(groups, minlength=len(subjects))[:, None, None]
+
+        idx = np.indices(n_retained.shape).reshape(3, -1)
+        summary.append(pd.DataFrame({'rt_variable': rt_variables[v], 'lower': lower[idx[1]], 'upper': upper[idx[2]],
+                                     'subj_idx': subjects[idx[0]],
+                                     'n_trials': np.broadcast_to(n_trials, n_retained.shape).ravel(),
+                                     'n_retained': n_retained.ravel(),
+                                     'mean_rt': mean.ravel(),
+                                     'median_rt': np.where(n_retained > 0, median, np.nan).ravel()}))
+    summary = pd.concat(summary, ignore_index=True)
+    summary['fraction_retained'] = summary['n_retained'] / summary['n_trials']
+
+    return masks, summary
+
+def save_rt_sweep(filename, trials, masks, summary, rt_variables, lower, upper):
+    """
+    Save the result of rt_cutoff_sweep in one compressed file: the retained-trial masks as bits,
+    the trials they belong to (eid and trialnum) and the summary table
+    """
+    eid_codes, eids = pd.factorize(trials['eid'])
+    np.savez_compressed(filename, masks=np.packbits(masks, axis=-1), n_trials=len(trials),
+                        rt_variables=np.asarray(rt_variables, dtype=str), lower=lower, upper=upper,
+                        eid_codes=eid_codes.astype(np.int32), eids=np.asarray(eids, dtype=str),
+                        trialnum=trials['trialnum'].to_numpy(),
+                        summary=summary.to_records(index=False, column_dtypes={'rt_variable': 'U32', 'subj_idx': 'U64'}))
+
+def load_rt_sweep(filename):
+    """
+    Load the result of save_rt_sweep: the masks (rt_variables, lower, upper, trials), a table of the trials
+    (eid and trialnum, in the order of the masks), the summary table and the grid of rt_variables, lower and upper
+    """
+    with np.load(filename) as f:
+        masks = np.unpackbits(f['masks'], axis=-1, count=int(f['n_trials'])).astype(bool)
+        trials = pd.DataFrame({'eid': f['eids'][f['eid_codes']], 'trialnum': f['trialnum']})
+        summary = pd.DataFrame.from_records(f['summary'])
+        grid = {'rt_variables': [str(v) for v in f['rt_variables']], 'lower': f['lower'], 'upper': f['upper']}
+    return masks, trials, summary, grid
+
+def fit_history_kernels(trials, n_lags=3, ridge=1e-3, max_iter=50, tol=1e-8):
+    """
+    Logistic regression of each rightward choice on a bias term, the (rescaled) stimulus and, for each lag up to n_lags,
+    the previous response (-1 left, 1 right) after a correct (prevcorrect, prevcorrect2, ...) and after an error trial
+    (preverror, preverror2, ...). Trials without a response or without the full history are left out.
+
+    All mice are fit at once with Newton (IRLS) steps on their stacked design matrices, with a small ridge penalty
+    to keep mice with (quasi-)separable choices finite. Returns one row per mouse and regressor with beta and its se.
+    """
+
+    from scipy.special import expit
+
+    suffixes = [''] + [str(lag) for lag in range(2, n_lags + 1)]
+    if any('prevresp' + s not in trials.columns for s in suffixes):
+        trials = compute_choice_history(trials.copy(), n_lags=n_lags)
+    stimulus = trials['stimulus'] if 'stimulus' in trials.columns else rescale_contrast(trials['signed_contrast'])
+
+    # design matrix: one column per regressor
+    names, columns = ['bias', 'stimulus'], [np.ones(len(trials)), stimulus.to_numpy(dtype=float, na_value=np.nan)]
+    for s in suffixes:
+        resp = 2 * trials['prevresp' + s].to_numpy(dtype=float, na_value=np.nan) - 1
+        fb = trials['prevfb' + s].to_numpy(dtype=float, na_value=np.nan)
+        names += ['prevcorrect' + s, 'preverror' + s]
+        columns += [np.where(np.isnan(fb), np.nan, resp * (fb == 1)), np.where(np.isnan(fb), np.nan, resp * (fb == -1))]
+    X = np.column_stack(columns)
+    y = trials['response'].to_numpy(dtype=float, na_value=np.nan)
+    keep = ~np.isnan(y) & ~np.isnan(X).any(axis=1)
+
+    # stack the trials of each mouse into subjects x trials x regressors, padded with zero-weight trials
+    subj_codes, subjects = pd.factorize(trials['subj_idx'][keep], sort=True)
+    row = pd.Series(subj_codes).groupby(subj_codes).cumcount().to_numpy()
+    n_trials = np.bincount(subj_codes, minlength=len(subjects))
+    Xs = np.zeros((len(subjects), n_trials.max(), len(names)))
+    ys, mask = np.zeros(Xs.shape[:2]), np.zeros(Xs.shape[:2])
+    Xs[subj_codes, row], ys[subj_codes, row], mask[subj_codes, row] = X[keep], y[keep], 1
+
+    # IRLS: Newton steps on the penalized log-likelihood, for all mice at once
+    beta = np.zeros((len(subjects), len(names)))
+    penalty = ridge * np.eye(len(names))
+    for _ in range(max_iter):
+        mu = expit(np.einsum('snp,sp->sn', Xs, beta))
+        grad = np.einsum('snp,sn->sp', Xs, (ys - mu) * mask) - ridge * beta
+        hessian = np.einsum('snp,sn,snq->spq', Xs, mu * (1 - mu) * mask, Xs, optimize=True) + penalty
+        step = np.linalg.solve(hessian, grad[:, :, None])[:, :, 0]
+        beta += step
+        if np.abs(step).max() < tol:
+            break
+
+    se = np.sqrt(np.diagonal(np.linalg.inv(hessian), axis1=1, axis2=2))
+    kernels = pd.DataFrame({'subj_idx': np.repeat(np.asarray(subjects), len(names)),
+                            'regressor': np.tile(names, len(subjects)),
+                            'lag': np.tile([0, 0] + [lag for lag in range(1, n_lags + 1) for _ in range(2)], len(subjects)),
+                            'beta': beta.ravel(), 'se': se.ravel(),
+                            'ntrials': np.repeat(n_trials, len(names))})
+    return kernels
+
+class HistoryMetrics(object):
+    """
+    Running choice history statistics for each subject, updated one session at a time (e.g. by get_data.py --stream):
+    per subject, previous response, previous feedback and signed contrast, the number of trials (ntrials_all),
+    of trials with a response (ntrials) and of rightward choices (nright).
+    Current metrics for a subject come from these tallies, without going back to the trials.
+
+    The tallies of each session are appended to a csv file, and summed when the file is read.
+    Trials without a previous response or feedback (e.g. the first of each session) are tallied too, with NaN there.
+    """
+
+    keys = ['subj_idx', 'prevresp', 'prevfb', 'signed_contrast']
+    counts = ['ntrials_all', 'ntrials', 'nright']
+
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.exists(filename):
+            log = pd.read_csv(filename, dtype={'subj_idx': str, 'eid': str})
+            self.sessions = log.drop_duplicates('eid').set_index('eid')['subj_idx']
+            self.tallies = log.groupby(self.keys, dropna=False)[self.counts].sum()
+        else:
+            self.sessions = pd.Series([], index=pd.Index([], name='eid'), name='subj_idx', dtype=str)
+            self.tallies = pd.DataFrame(columns=self.keys + self.counts, dtype=float).set_index(self.keys)
+
+    def update(self, trials):
+        """
+        Add the tallies of the sessions in trials (with the columns of compute_choice_history) that are not in yet
+        """
+        trials = trials[~trials['eid'].astype(str).isin(self.sessions.index)]
+        if not len(trials):
+            return
+        response = trials['response'].astype('float32')
+        cube = response.groupby([trials[g] for g in ['eid'] + self.keys], observed=True, dropna=False).agg(
+            ['size', 'count', 'sum'])
+        cube.columns = self.counts
+        cube = cube.reset_index().astype({'eid': str, 'subj_idx': str})
+        cube.to_csv(self.filename, mode='a', header=not os.path.exists(self.filename), index=False)
+
+        sessions = trials.drop_duplicates('eid')
+        self.sessions = pd.concat([self.sessions, pd.Series(sessions['subj_idx'].astype(str).to_numpy(),
+                                                            index=pd.Index(sessions['eid'].astype(str), name='eid'),
+                                                            name='subj_idx')])
+        self.tallies = pd.concat([self.tallies.reset_index(), cube.drop(columns='eid')]).astype(
+            {c: float for c in self.keys[1:] + self.counts}).groupby(self.keys, dropna=False)[self.counts].sum()
+
+    def metrics(self, subjects=None, fit=True):
+        """
+        Current history metrics for each subject (or only these subjects): number of sessions and trials,
+        probability of repeating the previous choice (overall, after correct and after error trials) and,
+        with fit=True, the history shift at 0% contrast after correct and after error trials (see utils_plot.history_shifts)
+
+        repeat is defined as in figure2_hddm.py: the fraction of all trials on which the response was the same as the
+        previous one, so trials without a response or without a previous response count as non-repeats.
+        """
+        tallies = self.tallies.reset_index()
+        if subjects is not None:
+            tallies = tallies[tallies['subj_idx'].isin(subjects)]
+        tallies['nrepeat'] = np.select([tallies['prevresp'] == 1, tallies['prevresp'] == 0],
+                                       [tallies['nright'], tallies['ntrials'] - tallies['nright']], 0)
+
+        per_subject = tallies.groupby('subj_idx')[['ntrials_all', 'nrepeat']].sum()
+        metrics = pd.DataFrame({'n_sessions': self.sessions.value_counts().reindex(per_subject.index),
+                                'ntrials': per_subject['ntrials_all'],
+                                'repeat': per_subject['nrepeat'] / per_subject['ntrials_all']})
+        per_fb = tallies.groupby(['subj_idx', 'prevfb'])[['ntrials_all', 'nrepeat']].sum()
+        repeat = (per_fb['nrepeat'] / per_fb['ntrials_all']).unstack('prevfb')
+        metrics['repeat_prevcorrect'] = repeat.get(1)
+        metrics['repeat_preverror'] = repeat.get(-1)
+
+        if fit and len(tallies):
+            from utils_plot import fit_psychfuncs, erf_psycho_2gammas
+            history = tallies.dropna(subset=['prevresp', 'prevfb'])
+            pars = fit_psychfuncs(history[history['ntrials'] > 0], ['subj_idx', 'prevresp', 'prevfb'])
+            pars['y'] = 100 * erf_psycho_2gammas(pars[['bias', 'threshold', 'lapselow', 'lapsehigh']].to_numpy(), [0.])[:, 0]
+            y = pars.set_index(['subj_idx', 'prevfb', 'prevresp'])['y'].unstack('prevresp')
+            shift = (y[1] - y[0]).unstack('prevfb')
+            metrics['history_shift_prevcorrect'] = shift.get(1)
+            metrics['history_shift_preverror'] = shift.get(-1)
+
+        return metrics
@@ -0,0 +1,164 @@
+"""
+read and write the trial data: a Parquet store, partitioned by subject, with a compact schema
+
+"""
+
+import pandas as pd
+import numpy as np
+import os, re, glob, shutil
+
+# explicit dtypes for the trial data - response and the history columns can be missing, so use nullable integers
+trial_dtypes = {'eid': 'category', 'subj_idx': 'category', 'lab': 'category', 'date': 'category',
+                'signed_contrast': 'float32', 'stimulus': 'float32',
+                'response': 'Int8', 'feedbackType': 'int8', 'trialnum': 'int32',
+                'trial_duration': 'float32', 'firstmove_time': 'float32', 'rt': 'float32',
+                'prevresp': 'Int8', 'prevfb': 'Int8', 'prevcontrast': 'float32',
+                'nextresp': 'Int8', 'nextfb': 'Int8', 'nextcontrast': 'float32'}
+
+
+def apply_dtypes(df):
+    """
+    Cast all columns that are in the schema to their compact dtype
+    (history columns at lag 2 and up, e.g. prevresp2, have the same dtype as lag 1).
+    Categories are sorted, so that sorting by e.g. subj_idx and date sorts by name and date: read from the store,
+    they come in the order of its (randomly named) files
+    """
+    dtypes = {col: trial_dtypes.get(col, trial_dtypes.get(re.sub(r'\d+$', '', col))) for col in df.columns}
+    df = df.astype({col: dtype for col, dtype in dtypes.items() if dtype is not None})
+    for col, dtype in dtypes.items():
+        if dtype == 'category' and not df[col].cat.categories.is_monotonic_increasing:
+            df[col] = df[col].cat.reorder_categories(sorted(df[col].cat.categories))
+    return df
+
+
+def write_trials(df, path, partition_cols=None, append=False):
+    """
+    Write trials to a Parquet store at path, with one folder per subject (within one folder per lab,
+    if there is a lab column), or per partition_cols.
+    With append=True, the trials are added to an existing store (e.g. one session at a time).
+    Otherwise the new store is written next to the old one and only then put in its place, so that a crash
+    while writing never leaves neither.
+    """
+    if partition_cols is None:
+        partition_cols = ['lab', 'subj_idx'] if 'lab' in df.columns else ['subj_idx']
+    if append:
+        apply_dtypes(df).to_parquet(path, engine='pyarrow', partition_cols=partition_cols, index=False)
+        return
+
+    for p in [path + '.tmp', path + '.old']:
+        if os.path.exists(p): shutil.rmtree(p)
+    apply_dtypes(df).to_parquet(path + '.tmp', engine='pyarrow', partition_cols=partition_cols, index=False)
+    if os.path.exists(path):
+        os.replace(path, path + '.old')
+    os.replace(path + '.tmp', path)
+    if os.path.exists(path + '.old'):
+        shutil.rmtree(path + '.old')
+
+
+def read_trials(path, columns=None, subjects=None):
+    """
+    Read trials from a Parquet store, only loading the columns and subjects that are asked for
+    """
+    filters = [('subj_idx', 'in', list(subjects))] if subjects is not None else None
+    df = pd.read_parquet(path, engine='pyarrow', columns=columns, filters=filters)
+    return apply_dtypes(df)
+
+
+def remove_sessions(path, eids):
+    """
+    Remove sessions from a Parquet store, e.g. when a run crashed while writing them.
+    Only the files that hold these sessions are read and rewritten, one at a time: each is written to a hidden
+    temporary file (which readers of the store skip) and then replaces the original, so a crash loses nothing.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if not os.path.exists(path) or not len(eids):
+        return
+    for filename in glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True):
+        if not pq.read_table(filename, columns=['eid']).column('eid').to_pandas().isin(eids).any():
+            continue
+        df = pq.read_table(filename).to_pandas()
+        df = df[~df['eid'].isin(eids)]
+        if not len(df):
+            os.remove(filename)
+            continue
+        tmp_file = os.path.join(os.path.dirname(filename), '.' + os.path.basename(filename) + '.tmp')
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_file)
+        os.replace(tmp_file, filename)
+
+
+# trials that preload_trials keeps in memory, by absolute path
+_preloaded = {}
+
+
+def preload_trials(path):
+    """
+    Keep all trials at path in memory, so that load_trials serves them without reading the store again
+    (e.g. in the worker processes of make_figures.py, which get them from the parent when they are forked)
+    """
+    _preloaded[os.path.abspath(path)] = load_trials(path)
+
+
+def load_trials(path, columns=None, subjects=None):
+    """
+    Load trials from the Parquet store at path, or from path + '.csv' if there is no store (or no pyarrow);
+    or from memory, after preload_trials(path)
+    """
+
+    if os.path.abspath(path) in _preloaded:
+        df = _preloaded[os.path.abspath(path)]
+        if subjects is not None:
+            df = df[df['subj_idx'].isin(subjects)].reset_index(drop=True)
+        return df[list(columns)] if columns is not None else df.copy()
+
+    try:
+        import pyarrow
+        has_pyarrow = True
+    except ImportError:
+        has_pyarrow = False
+
+    if has_pyarrow and os.path.isdir(path):
+        return read_trials(path, columns=columns, subjects=subjects)
+
+    # parse straight into the compact dtypes, so that the full table never sits in memory as float64 and strings
+    csv_dtypes = {col: dtype for col, dtype in trial_dtypes.items() if columns is None or col in columns}
+    df = pd.read_csv(path + '.csv', usecols=columns, dtype=csv_dtypes)
+    if subjects is not None:
+        df = df[df['subj_idx'].isin(subjects)].reset_index(drop=True)
+    return apply_dtypes(df)
+
+
+def memory_report(df):
+    """
+    Memory usage of each column of the trial data (in MB and bytes per trial), and the total
+    """
+    usage = df.memory_usage(deep=True, index=False)
+    report = pd.DataFrame({'dtype': df.dtypes.astype(str), 'MB': usage / 1e6,
+                           'bytes_per_trial': usage / max(len(df), 1)})
+    report.loc['total'] = ['', report['MB'].sum(), report['bytes_per_trial'].sum()]
+    return report
+
+
+def sufficient_statistics(df, conditions=[], quantiles=[0.1, 0.25, 0.5, 0.75, 0.9]):
+    """
+    Summarise the trials in one row per subject x signed contrast x conditions (e.g. ['prevresp', 'prevfb']):
+    the number of trials with a response (ntrials), the number of rightward choices (nright), their fraction,
+    and, if there is an rt column, the number of trials with an RT (n_rt) and the RT quantiles (rt_q10, ..., with rt_median for 0.5).
+    Psychometric fits and plots only need these cells, not every trial.
+    """
+
+    groups = ['subj_idx', 'signed_contrast'] + list(conditions)
+    response = df['response'].astype('float32')
+    cube = response.groupby([df[g] for g in groups], observed=True).agg(['count', 'sum'])
+    cube.columns = ['ntrials', 'nright']
+    cube['fraction'] = cube['nright'] / cube['ntrials']
+
+    if 'rt' in df.columns:
+        rt = df['rt'].astype('float32').groupby([df[g] for g in groups], observed=True)
+        cube['n_rt'] = rt.count()
+        rt_quantiles = rt.quantile(quantiles).unstack()
+        rt_quantiles.columns = ['rt_median' if q == 0.5 else 'rt_q%d'%round(q * 100) for q in quantiles]
+        cube = cube.join(rt_quantiles)
+
+    return cube.reset_index()
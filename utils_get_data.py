@@ -0,0 +1,448 @@
+"""
+helper functions for get_data.py: load trials from the IBL public server
+
+"""
+
+import pandas as pd
+import numpy as np
+import os, time, hashlib, threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from tqdm import tqdm
+
+# ============================================ #
+# LOCAL CACHE OF TRIALS OBJECTS
+# ============================================ #
+
+class TrialCache(object):
+    """
+    On-disk cache of trials objects, one .npz file per session, keyed by eid and dataset revision.
+    When the cache grows beyond max_size (in bytes), the least recently used sessions are removed.
+    """
+
+    def __init__(self, path, max_size=2e9):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock() # sessions can be loaded from several threads
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def key(self, one, eid):
+        # hash the paths and file hashes of the trials datasets, so that a new data release gets a new key
+        # without the revision (e.g. list_datasets failed), the session is not cached: returns None
+        try:
+            datasets = one.list_datasets(eid, filename='*trials*', details=True)
+            revision = ''.join(sorted(datasets['rel_path'].astype(str) + datasets['hash'].astype(str)))
+        except Exception:
+            return None
+        return '%s_%s'%(eid, hashlib.md5(revision.encode()).hexdigest()[:12])
+
+    def load_object(self, one, eid):
+        """
+        Drop-in for one.load_object(eid, 'trials'): read from disk if we have it, otherwise load and store
+        """
+
+        from one.alf.io import AlfBunch
+
+        key = self.key(one, eid)
+        if key is None:
+            return one.load_object(eid, 'trials')
+
+        filename = os.path.join(self.path, key + '.npz')
+        with self._lock:
+            if os.path.exists(filename):
+                os.utime(filename) # mark as recently used
+                with np.load(filename, allow_pickle=False) as f:
+                    return AlfBunch({k: f[k] for k in f.files})
+
+        trials_obj = one.load_object(eid, 'trials')
+
+        with self._lock:
+            # write to a temporary file first, so that a crash never leaves half a session in the cache
+            with open(filename + '.tmp', 'wb') as f:
+                np.savez(f, **{k: np.asarray(v) for k, v in trials_obj.items()})
+            os.replace(filename + '.tmp', filename)
+            self._evict()
+
+        return trials_obj
+
+    def _evict(self):
+        files = [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith('.npz')]
+        files = sorted(files, key=os.path.getmtime) # oldest first
+        total_size = sum(os.path.getsize(f) for f in files)
+        while total_size > self.max_size and len(files) > 1:
+            total_size -= os.path.getsize(files[0])
+            os.remove(files.pop(0))
+
+# ============================================ #
+# SELECT SESSIONS FOR ALL SUBJECTS AT ONCE
+# ============================================ #
+
+def query_training_status(one, subjects, sessions, criteria=['trained_1a', 'trained_1b'], n_jobs=1):
+    """
+    Find on which session each subject reached its training criterion: the first of criteria that was reached.
+    The training status of all subjects comes from a single Alyx query where possible; only subjects that are
+    missing from it fall back to brainbox' query_criterion (n_jobs at a time).
+
+    sessions is the ONE sessions cache table (indexed by eid), used to look up the session dates.
+    Returns a dataframe with subject, criterion, eid and date.
+    """
+
+    # 1. one REST call for all subjects, the criteria are stored as {status: [date, eid]} in the subject json
+    trained_criteria = {}
+    try:
+        for sj in one.alyx.rest('subjects', 'list'):
+            if sj['nickname'] in subjects and isinstance(sj.get('json'), dict) \
+                    and 'trained_criteria' in sj['json']:
+                trained_criteria[sj['nickname']] = sj['json']['trained_criteria']
+    except Exception:
+        print('cannot retrieve training status in bulk, querying subjects one by one')
+
+    # 2. fall back to one query per subject for the rest
+    def criterion_eid(subject):
+        for criterion in criteria:
+            if subject in trained_criteria:
+                eid = trained_criteria[subject].get(criterion, [None, None])[1]
+            else:
+                from brainbox.behavior.training import query_criterion
+                try: eid, n_sessions, n_days = query_criterion(subject, criterion, one=one)
+                except Exception: print('cannot retrieve training status for %s'%subject); return None, None
+            if eid is not None:
+                return criterion, eid
+        print('no %s found for %s'%(' or '.join(criteria), subject))
+        return None, None
+
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as pool:
+        found = list(tqdm(pool.map(criterion_eid, subjects), total=len(subjects)))
+
+    status = pd.DataFrame(found, columns=['criterion', 'eid'])
+    status['subject'] = subjects
+    status = status.dropna(subset=['eid'])
+    status['date'] = pd.to_datetime(sessions['date'].reindex(status['eid']).values)
+    if status['date'].isnull().any():
+        print('criterion session not in the cache for %s'%', '.join(status.loc[status['date'].isnull(), 'subject']))
+    return status.dropna(subset=['date'])[['subject', 'criterion', 'eid', 'date']]
+
+
+def select_sessions(sessions, status, n_sessions=3, protocol='trainingChoiceWorld'):
+    """
+    For all subjects at once, find the n_sessions sessions up to and including the session on which
+    the training criterion was reached (see query_training_status).
+    sessions is the ONE sessions cache table, indexed by eid and sorted by date within each subject.
+    Only subjects for which all of these sessions have the given task protocol are kept.
+    """
+
+    # merge rather than map, so that an empty status (e.g. all subjects already in the manifest) gives an empty window
+    sessions = sessions.reset_index().merge(status[['subject', 'date']].rename(columns={'date': 'date_reached'}),
+                                            on='subject', how='inner')
+    date_reached = pd.to_datetime(sessions['date_reached'])
+
+    # number each subject's sessions, and count how many there were until the criterion was reached
+    rank = sessions.groupby('subject').cumcount()
+    n_reached = (pd.to_datetime(sessions['date']) <= date_reached).groupby(sessions['subject']).transform('sum')
+    window = sessions[(rank >= n_reached - n_sessions) & (rank < n_reached)]
+
+    # assert that all of these have the right task protocol, and that there are n_sessions per subject
+    good_protocol = window['task_protocol'].str.contains(protocol, na=False).groupby(window['subject']).transform('all')
+    good_number = window.groupby('subject')['id'].transform('count') == n_sessions
+    for subject in window.loc[~good_protocol, 'subject'].unique():
+        print('not all sessions have %s for %s'%(protocol, subject))
+    for subject in window.loc[good_protocol & ~good_number, 'subject'].unique():
+        print('not %d sessions for %s'%(n_sessions, subject))
+    for subject in set(status['subject']) - set(window['subject']):
+        print('not %d sessions for %s'%(n_sessions, subject))
+
+    return window[good_protocol & good_number].drop(columns='date_reached')
+
+
+def select_all_sessions(sessions, protocol='ChoiceWorld', date_range=None):
+    """
+    Select every session with this task protocol (a regular expression, e.g. 'biased|ephys'),
+    optionally only between two dates, for all subjects - to ingest the whole database
+    sessions is the ONE sessions cache table, indexed by eid.
+    """
+    sessions = sessions.reset_index()
+    keep = sessions['task_protocol'].str.contains(protocol, na=False)
+    if date_range is not None:
+        dates = pd.to_datetime(sessions['date'])
+        keep = keep & (dates >= pd.Timestamp(date_range[0])) & (dates <= pd.Timestamp(date_range[1]))
+    return sessions[keep]
+
+
+def check_sessions(one, eids, cache=None, n_jobs=1):
+    """
+    Double check that the trials of each session can be loaded (filling the cache, if given).
+    Returns a list of the eids that could not be loaded.
+    """
+
+    def can_load(eid):
+        try:
+            if cache is not None: cache.load_object(one, eid)
+            else: one.load_object(eid, 'trials')
+            return True
+        except Exception:
+            return False
+
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as pool:
+        loaded = list(tqdm(pool.map(can_load, eids), total=len(eids)))
+    return [eid for eid, ok in zip(eids, loaded) if not ok]
+
+# ============================================ #
+# MANIFEST OF SELECTED, FETCHED AND WRITTEN SESSIONS
+# ============================================ #
+
+class SessionManifest(object):
+    """
+    Keeps track of which sessions have been selected, fetched and written to the trial store,
+    so that an interrupted or repeated run of get_data.py only loads the sessions that are still missing.
+    Each session has a status: 'selected', 'fetched', 'written' or 'failed', or 'raw_only' for sessions that are
+    in the raw trial store but could not be preprocessed (with get_data.py --stream); those are not loaded again.
+
+    Changes are appended to the csv file as they happen (so that this stays cheap for the whole database);
+    the file is compacted to one row per session whenever the manifest is opened.
+    """
+
+    columns = ['subject', 'status', 'ntrials', 'updated']
+
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.exists(filename):
+            self.sessions = pd.read_csv(filename).drop_duplicates('eid', keep='last').set_index('eid')
+        else:
+            self.sessions = pd.DataFrame(columns=['eid'] + self.columns).set_index('eid')
+        self.save()
+
+    def subjects(self):
+        return set(self.sessions['subject'])
+
+    def select(self, subjects, eids):
+        # add sessions (with the subject each belongs to) that are not in the manifest yet
+        new = pd.DataFrame({'eid': list(eids), 'subject': list(subjects), 'status': 'selected',
+                            'ntrials': np.nan, 'updated': pd.Timestamp.now().isoformat()}).set_index('eid')
+        new = new[~new.index.isin(self.sessions.index)]
+        self.sessions = pd.concat([self.sessions, new])
+        self._append(new)
+
+    def set_status(self, eid, status, ntrials=np.nan):
+        self.sessions.loc[eid, ['status', 'ntrials', 'updated']] = [status, ntrials, pd.Timestamp.now().isoformat()]
+        self._append(self.sessions.loc[[eid]])
+
+    def eids(self, status=None):
+        if status is None:
+            return self.sessions.index.tolist()
+        return self.sessions.index[self.sessions['status'] == status].tolist()
+
+    def todo(self):
+        # everything that has not made it into the output file yet, including failed sessions
+        return self.sessions.index[~self.sessions['status'].isin(['written', 'raw_only'])].tolist()
+
+    def _append(self, rows):
+        with open(self.filename, 'a') as f:
+            rows[self.columns].to_csv(f, header=False)
+
+    def save(self):
+        # write to a temporary file first, so that a crash never leaves a corrupted manifest
+        self.sessions[self.columns].to_csv(self.filename + '.tmp', index_label='eid')
+        os.replace(self.filename + '.tmp', self.filename)
+
+
+class PartitionProgress(object):
+    """
+    Progress and throughput per partition (e.g. lab/subject) while sessions come in.
+    partitions maps each eid to its partition; the time between two sessions coming in is counted
+    towards the partition of the second one.
+    """
+
+    def __init__(self, partitions):
+        self.partitions = partitions
+        self.stats = pd.DataFrame({'total': partitions.value_counts(), 'done': 0, 'failed': 0,
+                                   'ntrials': 0, 'seconds': 0.})
+        self._last = time.time()
+
+    def update(self, eid, ntrials=None):
+        now = time.time()
+        partition = self.partitions[eid]
+        self.stats.loc[partition, 'seconds'] += now - self._last
+        self._last = now
+        if ntrials is None:
+            self.stats.loc[partition, 'failed'] += 1
+        else:
+            self.stats.loc[partition, 'done'] += 1
+            self.stats.loc[partition, 'ntrials'] += ntrials
+
+        row = self.stats.loc[partition]
+        if row['done'] + row['failed'] == row['total']:
+            print('%s: %d/%d sessions, %d trials, %.2f sessions/s'%(partition, row['done'], row['total'],
+                                                                   row['ntrials'], row['done'] / row['seconds']))
+
+    def summary(self):
+        summary = self.stats.copy()
+        summary['sessions_per_s'] = summary['done'] / summary['seconds']
+        return summary
+
+# ============================================ #
+# LOAD AND REFORMAT ONE SESSION
+# ============================================ #
+
+def load_session(one, eid, cache=None, wheel_rt=False):
+    """
+    Load the trials of one session, add signed contrast and RTs, and return them as a dataframe.
+    Returns None (and prints why) when the session cannot be used.
+    If a TrialCache is given, the trials object is read from (or added to) that cache.
+    With wheel_rt=True, firstmove_time is left out here, to be computed from the wheel traces of
+    many sessions at once (see add_wheel_reaction_times).
+    """
+
+    try: trials_obj = cache.load_object(one, eid) if cache is not None else one.load_object(eid, 'trials')
+    except Exception: print('skipping %s, could not load trials'%eid); return None
+
+    trials_obj['signed_contrast'] = 100 * np.diff(np.nan_to_num(np.c_[trials_obj['contrastLeft'],
+                                                        trials_obj['contrastRight']]))
+
+    # use a very crude measure of RT: trial duration
+    trials_obj['trial_duration'] = trials_obj['response_times'] - trials_obj['goCue_times']
+
+    trials = trials_obj.to_df() # to dataframe
+    trials['trialnum'] = trials.index # to keep track of choice history
+    trials['response'] = trials['choice'].map({1: 0, 0: np.nan, -1: 1})
+
+    # better way to define RT: based on wheelMoves, Miles' code from Brainbox
+    # or, with wheel_rt, directly from the wheel traces (see first_movement_times)
+    # TODO: ask Miles why the public database does not contain wheel data for these training sessions?
+    # https://int-brain-lab.github.io/iblenv/notebooks_external/docs_wheel_moves.html#Finding-reaction-time-and-'determined'-movements
+    # the extracted first movement times in the (cached) trials object are what brainbox would return, without
+    # loading the trials again; only sessions without them need brainbox, which computes them from wheelMoves
+    if not wheel_rt and 'firstMovement_times' in trials_obj:
+        trials['firstmove_time'] = trials_obj['firstMovement_times'] - trials_obj['goCue_times']
+    elif not wheel_rt:
+        from brainbox.io.one import load_wheel_reaction_times
+        try: trials['firstmove_time'] = load_wheel_reaction_times(eid, one=one)
+        except Exception: print('skipping %s, no RTs'%eid); return None
+
+    # retrieve the mouse name, session etc
+    try: ref_dict = one.eid2ref(eid)
+    except Exception: print('skipping %s, could not retrieve session reference'%eid); return None
+    trials['eid'] = eid
+    trials['subj_idx'] = ref_dict.subject
+    trials['date'] = str(ref_dict.date)
+
+    return trials
+
+# ============================================ #
+# LOAD MANY SESSIONS AT ONCE
+# ============================================ #
+
+def fetch_sessions(one, eids, n_jobs=1, cache=None, wheel_rt=False):
+    """
+    Load a list of sessions with load_session, keeping up to n_jobs sessions in flight at the same time.
+    Most of the time is spent waiting on the server, so threads are enough here.
+
+    Yields (eid, trials) in the same order as eids; trials is None when a session was skipped.
+    """
+
+    if n_jobs <= 1:
+        for eid in tqdm(eids):
+            yield eid, load_session(one, eid, cache=cache, wheel_rt=wheel_rt)
+        return
+
+    # never more than n_jobs sessions in flight (or waiting to be picked up), handed out in input order
+    # so that memory stays bounded when the caller processes each session as it comes in
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        pending = deque()
+        for eid in tqdm(eids):
+            pending.append((eid, pool.submit(load_session, one, eid, cache=cache, wheel_rt=wheel_rt)))
+            if len(pending) >= n_jobs:
+                eid_done, future = pending.popleft()
+                yield eid_done, future.result()
+        while pending:
+            eid_done, future = pending.popleft()
+            yield eid_done, future.result()
+
+# ============================================ #
+# FIRST MOVEMENT TIMES FROM THE WHEEL, FOR MANY SESSIONS AT ONCE
+# ============================================ #
+
+def first_movement_times(timestamps, positions, go_cues, feedbacks,
+                         pos_thresh=8 * 2 * np.pi / 4096, speed_thresh=0.05):
+    """
+    Vectorized first movement detection for a batch of sessions.
+    timestamps and positions hold one wheel trace per session, go_cues and feedbacks one array of trial times per session.
+
+    All wheel traces are concatenated (each shifted in time, so that time keeps increasing), and each trial is a
+    window [goCue, feedback] into this long array. The first movement is the first time the wheel is more than
+    pos_thresh (radians, default 8 encoder ticks) away from its position at the go cue, traced back to the onset
+    of that movement: the last sample before it where the wheel was still (speed below speed_thresh, rad/s).
+
+    Returns a list with the first movement time relative to the go cue for each trial in each session,
+    NaN when the wheel did not move during the trial.
+    """
+
+    n_samples = np.array([len(t) for t in timestamps])
+    n_trials = np.array([len(g) for g in go_cues])
+    assert all(n_samples > 0), 'empty wheel trace'
+
+    # shift each session in time, so that the concatenated timestamps keep increasing
+    spans = np.array([t[-1] - t[0] + 1. for t in timestamps])
+    offsets = np.r_[0, np.cumsum(spans)[:-1]] - np.array([t[0] for t in timestamps])
+    t = np.concatenate([ts + off for ts, off in zip(timestamps, offsets)])
+    pos = np.concatenate(positions).astype(float)
+    go = np.concatenate([g + off for g, off in zip(go_cues, offsets)])
+    fb = np.concatenate([f + off for f, off in zip(feedbacks, offsets)])
+
+    # each trial's window of samples, not leaving its own session
+    first_sample = np.repeat(np.r_[0, np.cumsum(n_samples)[:-1]], n_trials)
+    last_sample = np.repeat(np.cumsum(n_samples), n_trials)
+    start = np.clip(np.searchsorted(t, go), first_sample, last_sample)
+    end = np.clip(np.searchsorted(t, fb, side='right'), start, last_sample)
+    end[np.isnan(go) | np.isnan(fb)] = start[np.isnan(go) | np.isnan(fb)] # no window for these trials
+    baseline = pos[np.clip(start - 1, first_sample, last_sample - 1)] # wheel position at the go cue
+
+    # label every sample with the trial window it falls in, and find where the wheel moved far enough
+    idx = np.arange(len(t))
+    trial = np.searchsorted(start, idx, side='right') - 1
+    in_window = (trial >= 0) & (idx < end[np.maximum(trial, 0)])
+    moved = in_window & (np.abs(pos - baseline[np.maximum(trial, 0)]) > pos_thresh)
+    moved_trials, first = np.unique(trial[moved], return_index=True)
+    crossing = idx[moved][first]
+
+    # trace each crossing back to the last sample where the wheel was still (but not before the go cue)
+    speed = np.r_[0, np.abs(np.diff(pos)) / np.maximum(np.diff(t), 1e-6)]
+    last_still = np.maximum.accumulate(np.where(speed < speed_thresh, idx, 0))
+    onset = np.maximum(last_still[crossing], start[moved_trials])
+
+    rt = np.full(len(go), np.nan)
+    rt[moved_trials] = t[onset] - go[moved_trials]
+    return np.split(rt, np.cumsum(n_trials)[:-1])
+
+
+def add_wheel_reaction_times(one, sessions, batch_size=20, n_jobs=1):
+    """
+    Add firstmove_time to sessions from fetch_sessions(..., wheel_rt=True), computed from the wheel traces
+    of batch_size sessions at a time. Like fetch_sessions, yields (eid, trials) in order.
+    """
+
+    def load_wheel(eid):
+        try: return one.load_object(eid, 'wheel')
+        except Exception: return None
+
+    sessions = iter(sessions)
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as pool:
+        while True:
+            batch = [s for _, s in zip(range(batch_size), sessions)]
+            if not batch: return
+
+            wheels = list(pool.map(load_wheel, [eid for eid, trials in batch]))
+            good = [i for i, (eid, trials) in enumerate(batch) if trials is not None
+                    and wheels[i] is not None and len(wheels[i]['timestamps'])]
+            rts = first_movement_times([wheels[i]['timestamps'] for i in good],
+                                       [wheels[i]['position'] for i in good],
+                                       [batch[i][1]['goCue_times'].values for i in good],
+                                       [batch[i][1]['feedback_times'].values for i in good]) if good else []
+
+            for i, (eid, trials) in enumerate(batch):
+                if trials is not None and i not in good:
+                    print('skipping %s, no RTs'%eid)
+                    trials = None
+                elif trials is not None:
+                    trials['firstmove_time'] = rts[good.index(i)]
+                yield eid, trials
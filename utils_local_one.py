@@ -0,0 +1,254 @@
+"""
+local stand-in for ONE/Alyx, to test and benchmark get_data.py without the IBL public server,
+and to run it from an offline snapshot (e.g. on cluster nodes without internet access)
+
+"""
+
+import pandas as pd
+import numpy as np
+import os, io, json, time, fnmatch, hashlib, threading, zipfile
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+# ============================================ #
+# STAND-IN FOR THE ONE API
+# ============================================ #
+
+class LocalONE(object):
+    """
+    Serves the parts of the ONE API that get_data.py uses (the sessions cache table, alyx.rest on
+    sessions and subjects, load_object, list_datasets and eid2ref) from a fixture directory made by make_fixture,
+    or from a snapshot file made by pack_snapshot (in which case every file is checked against its checksum).
+
+    Every request waits for latency seconds, and requests for a session's data fail with probability
+    failure_rate, to mimic a slow or flaky connection to the server.
+    """
+
+    def __init__(self, path, latency=0., failure_rate=0., seed=None):
+        self.path = path
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock() # requests can come from several threads
+
+        if os.path.isdir(path):
+            self._zip = None
+        else:
+            self._zip = zipfile.ZipFile(path)
+            self.snapshot = json.loads(self._zip.read('snapshot.json'))
+            print('snapshot version %s, %d sessions'%(self.snapshot['version'], len(self.snapshot['eids'])))
+
+        sessions = pd.read_csv(io.BytesIO(self._read('sessions.csv')), index_col='id')
+        sessions['date'] = pd.to_datetime(sessions['date']).dt.date
+        self._cache = SimpleNamespace(sessions=sessions)
+        self._subjects = json.loads(self._read('subjects.json'))
+        self.alyx = LocalAlyx(self)
+
+    def _read(self, name):
+        if self._zip is None:
+            with open(os.path.join(self.path, name), 'rb') as f:
+                return f.read()
+        with self._lock:
+            data = self._zip.read(name)
+        if hashlib.sha256(data).hexdigest() != self.snapshot['checksums'][name]:
+            raise IOError('checksum mismatch for %s in %s'%(name, self.path))
+        return data
+
+    def _files(self, eid):
+        if self._zip is None:
+            return sorted(os.listdir(os.path.join(self.path, eid)))
+        return sorted(n.split('/')[1] for n in self.snapshot['checksums'] if n.startswith(eid + '/'))
+
+    def _request(self, what, can_fail=True):
+        time.sleep(self.latency)
+        if not can_fail:
+            return
+        with self._lock:
+            failed = self._rng.random() < self.failure_rate
+        if failed:
+            raise ConnectionError('injected failure for %s'%what)
+
+    def load_object(self, eid, obj, **kwargs):
+        from one.alf.io import AlfBunch
+
+        self._request('%s/%s'%(eid, obj))
+        if '%s.npz'%obj not in self._files(eid):
+            raise FileNotFoundError('no %s object for %s'%(obj, eid))
+        with np.load(io.BytesIO(self._read('%s/%s.npz'%(eid, obj)))) as f:
+            return AlfBunch({k: f[k] for k in f.files})
+
+    def list_datasets(self, eid, filename=None, details=False, **kwargs):
+        self._request('%s/datasets'%eid)
+        files = self._files(eid)
+        if filename is not None:
+            files = [f for f in files if fnmatch.fnmatch(f, filename)]
+        if not details:
+            return files
+        hashes = [hashlib.sha256(self._read('%s/%s'%(eid, f))).hexdigest() if self._zip is None
+                  else self.snapshot['checksums']['%s/%s'%(eid, f)] for f in files]
+        return pd.DataFrame({'rel_path': files, 'hash': hashes})
+
+    def eid2ref(self, eid):
+        self._request('%s/ref'%eid)
+        session = self._cache.sessions.loc[eid]
+        return SimpleNamespace(subject=session['subject'], date=session['date'], sequence=session['number'])
+
+
+class LocalAlyx(object):
+    """
+    Answers alyx.rest queries for sessions and subjects
+    """
+
+    def __init__(self, one):
+        self.one = one
+
+    def rest(self, endpoint, action, **kwargs):
+        self.one._request('%s/%s'%(endpoint, action), can_fail=False)
+
+        if endpoint == 'sessions' and action == 'list':
+            sessions = self.one._cache.sessions.reset_index()
+            if 'task_protocol' in kwargs:
+                sessions = sessions[sessions['task_protocol'].str.contains(kwargs['task_protocol'])]
+            if 'subject' in kwargs:
+                sessions = sessions[sessions['subject'] == kwargs['subject']]
+            sessions['date'] = sessions['date'].astype(str)
+            return sessions.to_dict('records')
+
+        elif endpoint == 'subjects' and action == 'list':
+            return self.one._subjects
+
+        elif endpoint == 'subjects' and action == 'read':
+            for sj in self.one._subjects:
+                if sj['nickname'] == kwargs['id']:
+                    return sj
+            raise KeyError('no subject %s'%kwargs['id'])
+
+        raise NotImplementedError('%s/%s is not served locally'%(endpoint, action))
+
+# ============================================ #
+# OFFLINE SNAPSHOT
+# ============================================ #
+
+def pack_snapshot(one, eids, status, filename, objects=['trials', 'wheel', 'wheelMoves'], n_jobs=1):
+    """
+    Pack everything get_data.py needs for these sessions into one versioned, checksummed file,
+    which LocalONE reads without any network access: the sessions cache table (for the subjects in status and the sessions in eids),
+    the training status of each subject (from utils_get_data.query_training_status) and the objects of each session.
+    Objects that a session does not have (e.g. no wheel data) are left out.
+    """
+
+    sessions = one._cache.sessions.reset_index()
+    sessions = sessions[sessions['subject'].isin(status['subject']) | sessions['id'].isin(eids)]
+    subjects = [{'nickname': row.subject, 'json': {'trained_criteria': {row.criterion: [str(row.date.date()), row.eid]}}}
+                for row in status.itertuples()]
+
+    def load_objects(eid):
+        files = {}
+        for obj in objects:
+            try: data = one.load_object(eid, obj)
+            except Exception: print('no %s for %s, not in snapshot'%(obj, eid)); continue
+            buffer = io.BytesIO()
+            np.savez(buffer, **{k: np.asarray(v) for k, v in data.items()})
+            files['%s/%s.npz'%(eid, obj)] = buffer.getvalue()
+        return files
+
+    checksums = {}
+    with zipfile.ZipFile(filename + '.tmp', 'w', zipfile.ZIP_STORED) as z:
+
+        def add(name, data):
+            z.writestr(name, data)
+            checksums[name] = hashlib.sha256(data).hexdigest()
+
+        add('sessions.csv', sessions.to_csv(index=False).encode())
+        add('subjects.json', json.dumps(subjects).encode())
+
+        # download n_jobs sessions at a time, but write them to the snapshot one by one
+        with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as pool:
+            for files in tqdm(pool.map(load_objects, eids), total=len(eids)):
+                for name, data in files.items():
+                    add(name, data)
+
+        z.writestr('snapshot.json', json.dumps({'version': pd.Timestamp.now().strftime('%Y%m%d'),
+                                                'created': pd.Timestamp.now().isoformat(),
+                                                'eids': list(eids), 'objects': objects,
+                                                'checksums': checksums}))
+    os.replace(filename + '.tmp', filename)
+
+# ============================================ #
+# SYNTHETIC FIXTURE
+# ============================================ #
+
+def make_fixture(path, n_subjects=20, n_sessions=8, n_trials=600, trained_session=4, seed=0):
+    """
+    Write a fixture directory for LocalONE: n_subjects mice with n_sessions each, of which the first
+    ones are trainingChoiceWorld and the ones after trained_session are biasedChoiceWorld.
+    Each session has a trials, wheel and wheelMoves object with n_trials simulated trials.
+    """
+
+    assert trained_session < n_sessions, 'the mice need to reach trained_1a within n_sessions'
+    rng = np.random.default_rng(seed)
+    contrasts = np.array([-1., -0.25, -0.125, -0.0625, 0., 0.0625, 0.125, 0.25, 1.])
+    sessions, subjects = [], []
+
+    for sj in range(n_subjects):
+        subject = 'SIM%03d'%sj
+        dates = pd.Timestamp('2020-01-06') + pd.to_timedelta(np.arange(n_sessions) + sj % 7, unit='D')
+        eids = [_uuid(rng) for _ in range(n_sessions)]
+
+        for s, (eid, date) in enumerate(zip(eids, dates)):
+            protocol = '_iblrig_tasks_trainingChoiceWorld6.4.2' if s <= trained_session \
+                else '_iblrig_tasks_biasedChoiceWorld6.4.2'
+            sessions.append({'id': eid, 'lab': 'lab%d'%(sj % 5), 'subject': subject, 'date': date.date(),
+                             'number': 1, 'task_protocol': protocol, 'projects': 'ibl_neuropixel_brainwide_01'})
+            _write_session(os.path.join(path, eid), contrasts, n_trials, rng)
+
+        subjects.append({'nickname': subject,
+                         'json': {'trained_criteria': {'trained_1a': [str(dates[trained_session].date()),
+                                                                      eids[trained_session]]}}})
+
+    pd.DataFrame(sessions).to_csv(os.path.join(path, 'sessions.csv'), index=False)
+    with open(os.path.join(path, 'subjects.json'), 'w') as f:
+        json.dump(subjects, f)
+
+
+def _uuid(rng):
+    h = rng.bytes(16).hex()
+    return '%s-%s-%s-%s-%s'%(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def _write_session(path, contrasts, n_trials, rng, fs=100):
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    # trials: a noisy psychometric observer
+    signed_contrast = rng.choice(contrasts, n_trials)
+    p_right = 0.1 + 0.8 / (1 + np.exp(-8 * signed_contrast))
+    choice = np.where(rng.random(n_trials) < p_right, -1, 1) # -1 is a rightward choice in the IBL task
+    choice[rng.random(n_trials) < 0.02] = 0 # some no-go trials
+    correct = np.sign(-signed_contrast) == choice
+    feedbackType = np.where(correct | ((signed_contrast == 0) & (rng.random(n_trials) < 0.5)), 1, -1)
+
+    start = np.cumsum(rng.uniform(3, 6, n_trials))
+    goCue = start + 0.5
+    firstmove = goCue + rng.lognormal(np.log(0.3), 0.5, n_trials)
+    response = firstmove + rng.uniform(0.1, 0.4, n_trials)
+    np.savez(os.path.join(path, 'trials.npz'),
+             contrastLeft=np.where(signed_contrast < 0, -signed_contrast, np.nan),
+             contrastRight=np.where(signed_contrast > 0, signed_contrast, np.nan),
+             choice=choice, feedbackType=feedbackType,
+             goCue_times=goCue, stimOn_times=goCue, response_times=response,
+             feedback_times=response + 0.01, firstMovement_times=firstmove,
+             intervals=np.c_[start, response + 1.], probabilityLeft=np.full(n_trials, 0.5))
+
+    # wheel: still, except for one movement per trial between first movement and response
+    timestamps = np.arange(0, start[-1] + 6, 1 / fs)
+    direction = np.where(choice == 0, 1, choice)
+    velocity = np.zeros(len(timestamps) + 1)
+    np.add.at(velocity, np.searchsorted(timestamps, firstmove), 0.5 * direction)
+    np.add.at(velocity, np.searchsorted(timestamps, response), -0.5 * direction)
+    position = np.cumsum(np.cumsum(velocity)[:-1]) / fs
+    np.savez(os.path.join(path, 'wheel.npz'), timestamps=timestamps, position=position)
+    np.savez(os.path.join(path, 'wheelMoves.npz'), intervals=np.c_[firstmove, response],
+             peakAmplitude=0.5 * (response - firstmove) * direction)
@@ -6,6 +6,8 @@ Guido Meijer, Anne Urai, Alejandro Pan Vazquez & Miles Wells
 16 Jan 2020
 """
 import os
+import hashlib
+from contextlib import contextmanager
 import seaborn as sns
 import matplotlib
 import numpy as np
@@ -64,43 +66,401 @@ def datapath():
 # DEFINE PSYCHFUNCFIT TO WORK WITH FACETGRID IN SEABORN
 # ================================================================== #
 
-def fit_psychfunc(df):
-
-    import brainbox.behavior.pyschofit as psy
+def fit_psychfunc(df, choice='response', cache=None):
+    """
+    Fit a psychometric function to trials, or to the cells of utils_data.sufficient_statistics
+    (with ntrials and nright columns). With a FitCache, fits to the same data are only done once.
+    """
 
-    choicedat = df.groupby('signed_contrast').agg(
-        {'choice': 'count', 'choice2': 'mean'}).reset_index()
-    if len(choicedat) >= 4: # need some minimum number of unique x-values
-        pars, L = psy.mle_fit_psycho(choicedat.values.transpose(), P_model='erf_psycho_2gammas',
-                                 parstart=np.array(
-                                     [0, 20., 0.05, 0.05]),
-                                 parmin=np.array(
-                                     [choicedat['signed_contrast'].min(), 5, 0., 0.]),
-                                 parmax=np.array([choicedat['signed_contrast'].max(), 40., 1, 1]))
+    # number of trials and fraction of rightward choices at each contrast
+    if 'nright' in df.columns:
+        choicedat = df.groupby('signed_contrast')[['ntrials', 'nright']].sum().reset_index()
+        choicedat['nright'] = choicedat['nright'] / choicedat['ntrials']
     else:
-        pars = [np.nan, np.nan, np.nan, np.nan]
+        choicedat = df.groupby('signed_contrast')[choice].agg(['count', 'mean']).reset_index()
+    pars = _mle_fit_psychfunc(choicedat.to_numpy(dtype=float, na_value=np.nan).transpose(), cache=cache)
 
     df2 = {'bias': pars[0], 'threshold': pars[1],
            'lapselow': pars[2], 'lapsehigh': pars[3]}
     df2 = pd.DataFrame(df2, index=[0])
 
-    df2['ntrials'] = df['choice'].count()
+    df2['ntrials'] = df['ntrials'].sum() if 'nright' in df.columns else df[choice].count()
 
     return df2
 
 
-def plot_psychometric(x, y, subj, **kwargs):
+def _mle_fit_psychfunc(choicedat, cache=None):
+    """
+    Fit erf_psycho_2gammas to an array of contrasts, number of trials and fraction of rightward choices (3 x contrasts)
+    """
+
+    if choicedat.shape[1] < 4: # need some minimum number of unique x-values
+        return np.full(4, np.nan)
+
+    parstart = np.array([0, 20., 0.05, 0.05])
+    parmin = np.array([choicedat[0].min(), 5, 0., 0.])
+    parmax = np.array([choicedat[0].max(), 40., 1, 1])
+    if cache is not None:
+        key = psychfunc_key(choicedat[0], choicedat[1], choicedat[1] * choicedat[2], parstart, parmin, parmax, 'mle_fit_psycho')
+        if key in cache:
+            return cache[key]
 
     import brainbox.behavior.pyschofit as psy
+    pars, L = psy.mle_fit_psycho(choicedat, P_model='erf_psycho_2gammas',
+                                 parstart=parstart, parmin=parmin, parmax=parmax)
+    if cache is not None:
+        cache.add([key], [pars])
+    return pars
+
+
+def psychfunc_key(x, n, k, parstart, parmin, parmax, method):
+    """
+    Hash of the data of one psychometric fit (contrasts x, number of trials n and rightward choices k,
+    which are not always whole numbers, e.g. averaged over observers) and the fit settings
+    """
+    keep = n > 0
+    order = np.argsort(x[keep], kind='stable')
+    data = np.concatenate([x[keep][order], n[keep][order], np.round(k[keep][order], 6),
+                           parstart, parmin, parmax]).astype(np.float64)
+    return hashlib.sha1(data.tobytes() + method.encode()).hexdigest()
+
+
+class FitCache(object):
+    """
+    Psychometric fits on disk, keyed by psychfunc_key: re-running a figure script after a change to the plots
+    does not fit anything again. New fits are appended to a csv file, which several processes can share
+    (e.g. the figure scripts under make_figures.py): reads and appends hold a lock on the file.
+    """
+
+    columns = ['bias', 'threshold', 'lapselow', 'lapsehigh']
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fits = pd.DataFrame(columns=self.columns, index=pd.Index([], name='key'), dtype=float)
+        if os.path.exists(filename):
+            with self._locked('r') as f:
+                if os.fstat(f.fileno()).st_size:
+                    fits = pd.read_csv(f, dtype={'key': str})
+                    self.fits = fits.drop_duplicates('key', keep='last').set_index('key')[self.columns]
+
+    def __contains__(self, key):
+        return key in self.fits.index
+
+    def __getitem__(self, key):
+        return self.fits.loc[key].to_numpy(dtype=float)
+
+    def add(self, keys, pars):
+        if not len(keys):
+            return
+        new = pd.DataFrame(np.asarray(pars, dtype=float), index=pd.Index(keys, name='key'), columns=self.columns)
+        with self._locked('a') as f:
+            # only the first writer of the file writes the header
+            f.write(new.to_csv(header=not os.fstat(f.fileno()).st_size))
+        self.fits = pd.concat([self.fits, new])
+
+    @contextmanager
+    def _locked(self, mode):
+        try:
+            import fcntl
+        except ImportError: # e.g. on Windows: no lock, fine as long as one script at a time uses the cache
+            fcntl = None
+
+        with open(self.filename, mode) as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX if mode == 'a' else fcntl.LOCK_SH)
+            try:
+                yield f
+            finally:
+                f.flush()
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def fit_psychfuncs(df, groups, choice='response', parstart=[0, 20., 0.05, 0.05], nfits=5, seed=0,
+                   n_jobs=1, cache=None):
+    """
+    Fit the psychometric function of fit_psychfunc to every group at once, e.g. fit_psychfuncs(df, ['subj_idx', 'prevresp'])
+    instead of df.groupby(['subj_idx', 'prevresp']).apply(fit_psychfunc). df holds trials or the cells of
+    utils_data.sufficient_statistics. The likelihood of all groups and its gradient are computed on one
+    (groups x contrasts) array, and all groups are optimized together from parstart and nfits-1 random starting points.
+    With n_jobs > 1, the groups are split over that many (forked) processes, where the platform can fork;
+    with a FitCache, only new groups are fit.
+    Returns one row per group with bias, threshold, lapselow, lapsehigh and ntrials (the same for any n_jobs).
+    """
+
+    # number of trials and of rightward choices for each group and contrast
+    if 'nright' in df.columns:
+        cells = df.groupby(groups + ['signed_contrast'], observed=True)[['ntrials', 'nright']].sum()
+    else:
+        cells = df.groupby(groups + ['signed_contrast'], observed=True)[choice].agg(['count', 'sum'])
+        cells.columns = ['ntrials', 'nright']
+    cells = cells.reset_index()
+    cells = cells[cells['ntrials'] > 0]
+
+    # one row per group, padded with empty cells (which do not count towards the likelihood)
+    group_idx, group_keys = pd.factorize(pd.MultiIndex.from_frame(cells[groups]))
+    col_idx = cells.groupby(group_idx).cumcount().to_numpy()
+    shape = (len(group_keys), col_idx.max() + 1 if len(cells) else 0)
+    x, n, k = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    x[group_idx, col_idx] = cells['signed_contrast']
+    n[group_idx, col_idx] = cells['ntrials']
+    k[group_idx, col_idx] = cells['nright']
+    xmin = np.where(n > 0, x, np.inf).min(axis=1)
+    xmax = np.where(n > 0, x, -np.inf).max(axis=1)
+
+    # same bounds as fit_psychfunc, and a fit only for groups with some minimum number of unique x-values
+    parmin = np.column_stack([xmin, np.full(len(xmin), 5.), np.zeros(len(xmin)), np.zeros(len(xmin))])
+    parmax = np.column_stack([xmax, np.full(len(xmax), 40.), np.ones(len(xmax)), np.ones(len(xmax))])
+    fit = (n > 0).sum(axis=1) >= 4
+
+    pars = np.full((len(group_keys), 4), np.nan)
+    keys = {g: psychfunc_key(x[g], n[g], k[g], np.asarray(parstart, dtype=float), parmin[g], parmax[g],
+                             'fit_psychfuncs_%d_%d'%(nfits, seed)) for g in np.flatnonzero(fit)}
+    if cache is not None:
+        for g, key in keys.items():
+            if key in cache: pars[g] = cache[key]
+    todo = np.array([g for g in keys if np.isnan(pars[g, 0])], dtype=int)
+
+    if len(todo):
+        # the random starting points of each group only depend on its data, not on which other groups are fit
+        starts = np.empty((nfits, len(todo), 4))
+        for i, g in enumerate(todo):
+            rng = np.random.default_rng([seed, int(keys[g][:8], 16)])
+            starts[0, i] = np.clip(parstart, parmin[g], parmax[g])
+            starts[1:, i] = rng.uniform(parmin[g], parmax[g], size=(nfits - 1, 4))
+
+        chunks = np.array_split(np.arange(len(todo)), max(min(n_jobs, len(todo)), 1))
+        args = [(x[todo[c]], n[todo[c]], k[todo[c]], starts[:, c], parmin[todo[c]], parmax[todo[c]]) for c in chunks]
+        import multiprocessing as mp
+        if len(chunks) > 1 and 'fork' in mp.get_all_start_methods():
+            # forked workers, as the figure scripts that call this have no __main__ guard (spawned workers would
+            # run the whole script again)
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=len(chunks), mp_context=mp.get_context('fork')) as pool:
+                results = list(pool.map(_fit_psychfuncs_chunk, *zip(*args))) # in the order of the chunks
+        else:
+            results = [_fit_psychfuncs_chunk(*a) for a in args]
+        pars[todo] = np.concatenate(results)
+
+        if cache is not None:
+            cache.add([keys[g] for g in todo], pars[todo])
+
+    df2 = pd.DataFrame(list(group_keys), columns=groups)
+    df2['bias'], df2['threshold'], df2['lapselow'], df2['lapsehigh'] = pars.T
+    df2['ntrials'] = n.sum(axis=1).astype(int)
+    return df2
+
+
+def history_shifts(df, conditions=['fb'], xvec=[0.], lag=1, min_trials=0, correct=True, **fit_kwargs):
+    """
+    Difference in rightward choices (%) after a rightward vs. a leftward choice, for each subject and condition
+    of the previous trial (e.g. conditions=['fb', 'contrast'] for prevfb and prevcontrast), at each contrast in xvec.
+    history_shift comes from psychometric functions conditioned on the previous trial, future_shift from the same
+    conditioned on the next trial, and history_shift_corrected = history_shift - future_shift (Lak et al.).
+    With correct=False only the previous-trial curves are fit (future_shift and history_shift_corrected are NaN).
+
+    The previous- and next-trial psychometric functions are fit together with fit_psychfuncs (fit_kwargs, e.g.
+    n_jobs and cache), on groups with more than min_trials trials, and evaluated at xvec all at once.
+    """
+
+    cube, groups = _history_cube(df, conditions, lag, correct)
+    pars = fit_psychfuncs(cube, groups, **fit_kwargs)
+    return _history_shifts_from_fits(pars, groups, conditions, xvec, lag, min_trials).reset_index()
+
+
+def bootstrap_history_shifts(df, conditions=['fb'], xvec=[0.], lag=1, min_trials=0, n_boot=1000, ci=95, seed=0,
+                             correct=True, **fit_kwargs):
+    """
+    history_shifts with bootstrap confidence intervals (ci %, percentiles over n_boot resamples of the trials of
+    each subject and condition, columns history_shift_low, history_shift_high, etc.).
+
+    Resampling trials with replacement is a multinomial draw over the (contrast x choice) counts of each group,
+    so the resamples are drawn as count arrays, 100 resamples per random stream (spawned from seed, so that
+    the result does not depend on n_jobs), and all of them are fit as one batch by fit_psychfuncs.
+    """
+
+    cube, groups = _history_cube(df, conditions, lag, correct)
+    shifts = _history_shifts_from_fits(fit_psychfuncs(cube, groups, **fit_kwargs), groups, conditions, xvec, lag,
+                                       min_trials)
+
+    # counts of rightward and leftward choices at each contrast: groups x (contrasts x 2)
+    group_idx, group_keys = pd.factorize(pd.MultiIndex.from_frame(cube[groups]))
+    col_idx = cube.groupby(group_idx).cumcount().to_numpy()
+    counts = np.zeros((len(group_keys), col_idx.max() + 1, 2))
+    counts[group_idx, col_idx, 0] = cube['nright']
+    counts[group_idx, col_idx, 1] = cube['ntrials'] - cube['nright']
+    contrasts = np.full(counts.shape[:2], np.nan)
+    contrasts[group_idx, col_idx] = cube['signed_contrast']
+    ntrials = counts.sum(axis=(1, 2)).astype(int)
+    pvals = counts.reshape(len(counts), -1) / np.maximum(ntrials, 1)[:, None]
+
+    # resamples, in blocks of 100 with their own random stream
+    streams = np.random.SeedSequence(seed).spawn(int(np.ceil(n_boot / 100)))
+    draws = np.concatenate([np.random.default_rng(stream).multinomial(ntrials, pvals, size=(min(100, n_boot - 100 * b),
+                                                                                              len(ntrials)))
+                            for b, stream in enumerate(streams)]).reshape((n_boot,) + counts.shape)
+
+    # one cube with all resamples, fit at once
+    rep, g, c = np.nonzero(draws.sum(axis=-1) > 0)
+    boot = pd.DataFrame(list(group_keys[g]), columns=groups)
+    boot.insert(0, 'replicate', rep)
+    boot['signed_contrast'] = contrasts[g, c]
+    boot['ntrials'] = draws[rep, g, c].sum(axis=-1)
+    boot['nright'] = draws[rep, g, c, 0]
+    fit_kwargs.pop('cache', None) # resamples are not worth keeping
+    boot_pars = fit_psychfuncs(boot, ['replicate'] + groups, **fit_kwargs)
+    boot_shifts = _history_shifts_from_fits(boot_pars, ['replicate'] + groups, conditions, xvec, lag, min_trials)
+
+    # percentiles over the resamples
+    levels = [l for l in boot_shifts.index.names if l != 'replicate']
+    low = boot_shifts.groupby(level=levels).quantile((100 - ci) / 200)
+    high = boot_shifts.groupby(level=levels).quantile(1 - (100 - ci) / 200)
+    shifts = shifts.join(low.add_suffix('_low')).join(high.add_suffix('_high'))
+    return shifts.reset_index()
+
+
+def _history_cube(df, conditions, lag, correct=True):
+    """
+    Sufficient statistics for the previous- and next-trial conditions (column 'when'), with the columns renamed
+    to resp and conditions, so that they can be fit at once; without correct, only those of the previous trial
+    """
+    from utils_data import sufficient_statistics
+
+    suffix = '' if lag == 1 else str(lag)
+    cubes = []
+    for when in ['prev', 'next'] if correct else ['prev']:
+        columns = {when + c + suffix: c for c in ['resp'] + list(conditions)}
+        cube = sufficient_statistics(df, conditions=list(columns)).rename(columns=columns)
+        cube.insert(0, 'when', when)
+        cubes.append(cube)
+    return pd.concat(cubes, ignore_index=True), ['when', 'subj_idx', 'resp'] + list(conditions)
+
+
+def _history_shifts_from_fits(pars, groups, conditions, xvec, lag, min_trials):
+    """
+    Evaluate all fitted curves at xvec as one (groups x contrasts) array,
+    and take the shift after rightward vs. leftward choices on the previous and the next trial
+    """
+    pars = pars[pars['ntrials'] > min_trials]
+    xvec = np.atleast_1d(np.asarray(xvec, dtype=float))
+    y = 100 * erf_psycho_2gammas(pars[['bias', 'threshold', 'lapselow', 'lapsehigh']].to_numpy(), xvec)
+    y = pd.DataFrame(y, index=pd.MultiIndex.from_frame(pars[groups].astype({'resp': float})),
+                     columns=pd.Index(xvec, name='signed_contrast'))
+
+    shift = (y.xs(1., level='resp') - y.xs(0., level='resp')).stack().unstack('when')
+    shifts = pd.DataFrame({'history_shift': shift.get('prev'), 'future_shift': shift.get('next')}, index=shift.index,
+                          dtype=float)
+    shifts['history_shift_corrected'] = shifts['history_shift'] - shifts['future_shift']
+    shifts = shifts.dropna(subset=['history_shift', 'future_shift'], how='all')
+
+    suffix = '' if lag == 1 else str(lag)
+    return shifts.rename_axis(index={c: 'prev' + c + suffix for c in conditions})
+
+
+def erf_psycho_2gammas(pars, x):
+    """
+    erf_psycho_2gammas (as in brainbox.behavior.pyschofit) for many parameter sets at once:
+    pars is groups x 4 (bias, threshold, lapselow, lapsehigh), returns groups x len(x)
+    """
+    from scipy.special import erf
+
+    bias, threshold, lapselow, lapsehigh = [p[:, None] for p in np.asarray(pars, dtype=float).T]
+    return lapselow + (1 - lapselow - lapsehigh) * (erf((np.asarray(x)[None, :] - bias) / threshold) + 1) / 2
+
+
+def _fit_psychfuncs_chunk(x, n, k, starts, parmin, parmax):
+    """
+    Best fit of each group (rows of x, n, k) over all starting points (starts: starting points x groups x 4)
+    """
+    pars, best_nll = np.full((len(x), 4), np.nan), np.full(len(x), np.inf)
+    for start in starts:
+        p, nll = _fit_erf_psycho_2gammas(x, n, k, start, parmin, parmax)
+        better = nll < best_nll
+        pars[better], best_nll[better] = p[better], nll[better]
+    return pars
+
+
+def _erf_psycho_2gammas_nll(pars, x, n, k):
+    """
+    Negative log-likelihood of erf_psycho_2gammas for each group (rows of x, n, k), its gradient with respect to
+    bias, threshold, lapselow and lapsehigh, and the Fisher information (groups x 4 x 4)
+    """
+    from scipy.special import erf
+
+    bias, threshold, lapselow, lapsehigh = [p[:, None] for p in pars.T]
+    z = (x - bias) / threshold
+    phi = (erf(z) + 1) / 2
+    scale = 1 - lapselow - lapsehigh
+    p = np.clip(lapselow + scale * phi, 1e-12, 1 - 1e-12)
+
+    # derivative of p with respect to each parameter: groups x contrasts x 4
+    dphi_dz = np.exp(-z ** 2) / np.sqrt(np.pi)
+    dp = np.stack([-scale * dphi_dz / threshold, -scale * dphi_dz * z / threshold,
+                   1 - phi, -phi], axis=-1)
+
+    nll = -np.sum(k * np.log(p) + (n - k) * np.log(1 - p), axis=1)
+    grad = np.einsum('gc,gcp->gp', -(k / p - (n - k) / (1 - p)), dp)
+    fisher = np.einsum('gc,gcp,gcq->gpq', n / (p * (1 - p)), dp, dp)
+    return nll, grad, fisher
+
+
+def _fit_erf_psycho_2gammas(x, n, k, start, parmin, parmax, maxiter=500, tol=1e-10):
+    """
+    Minimize the negative log-likelihood of each group from one starting point, with damped Fisher scoring
+    (Levenberg-Marquardt) steps that are computed for all groups at once and kept within the bounds
+    """
+
+    pars = start.copy()
+    nll, grad, fisher = _erf_psycho_2gammas_nll(pars, x, n, k)
+    damping = np.full(len(pars), 1e-3)
+    active = np.ones(len(pars), dtype=bool)
+
+    for _ in range(maxiter):
+        if not active.any():
+            break
+        a = np.flatnonzero(active)
+
+        # parameters that sit at a bound, and would move out of it, stay where they are for this step
+        free = ~(((pars[a] <= parmin[a]) & (grad[a] > 0)) | ((pars[a] >= parmax[a]) & (grad[a] < 0)))
+        both_free = free[:, :, None] & free[:, None, :]
+        diag = np.einsum('gpp->gp', fisher[a])
+        system = np.where(both_free, fisher[a] + (damping[a, None] * diag + 1e-12)[:, :, None] * np.eye(4), np.eye(4))
+        step = np.linalg.solve(system, np.where(free, -grad[a], 0)[:, :, None])[:, :, 0]
+        new = np.clip(pars[a] + step, parmin[a], parmax[a])
+        new_nll, new_grad, new_fisher = _erf_psycho_2gammas_nll(new, x[a], n[a], k[a])
+
+        # keep the steps that improve the fit and take bolder steps there; elsewhere, take smaller steps
+        better = new_nll <= nll[a]
+        converged = (better & (nll[a] - new_nll < tol * (1 + np.abs(nll[a])))) | (damping[a] > 1e10)
+        ai = a[better]
+        pars[ai], nll[ai], grad[ai], fisher[ai] = new[better], new_nll[better], new_grad[better], new_fisher[better]
+        damping[ai] /= 3
+        damping[a[~better]] *= 10
+        active[a[converged]] = False
+
+    return pars, nll
+
+
+def plot_psychometric(x, y, subj, n=None, cache=None, errorbar=('ci', 95), **kwargs):
+    """
+    Plot the average psychometric function over observers, with the data of each observer on top.
+    y is the choice on each trial or, with n, the fraction of rightward choices in each cell of
+    utils_data.sufficient_statistics (and n the number of trials in that cell).
+    With a FitCache, only new fits are computed.
+    errorbar over observers: ('ci', 95) or ('se', 1), see summary_errorbars
+    """
 
     # summary stats - average psychfunc over observers
-    df = pd.DataFrame({'signed_contrast': x, 'choice': y,
-                       'choice2': y, 'subject_nickname': subj})
-    df2 = df.groupby(['signed_contrast', 'subject_nickname']).agg(
-        {'choice2': 'count', 'choice': 'mean'}).reset_index()
-    df2.rename(columns={"choice2": "ntrials",
-                        "choice": "fraction"}, inplace=True)
-    df2 = df2.groupby(['signed_contrast'])[['ntrials', 'fraction']].mean().reset_index()
+    df = pd.DataFrame({'signed_contrast': x, 'choice': y, 'subject_nickname': subj})
+    if n is None:
+        df_sj = df.groupby(['signed_contrast', 'subject_nickname'], observed=True).agg(
+            ntrials=('choice', 'count'), fraction=('choice', 'mean')).reset_index()
+    else:
+        df['ntrials'] = np.asarray(n)
+        df['nright'] = df['choice'] * df['ntrials']
+        df_sj = df.groupby(['signed_contrast', 'subject_nickname'], observed=True)[['ntrials', 'nright']].sum().reset_index()
+        df_sj['fraction'] = df_sj['nright'] / df_sj['ntrials']
+    df2 = df_sj.groupby(['signed_contrast'])[['ntrials', 'fraction']].mean().reset_index()
     #df2 = df2[['signed_contrast', 'ntrials', 'fraction']]
 
     # only 'break' the x-axis and remove 50% contrast when 0% is present
@@ -111,49 +471,37 @@ def plot_psychometric(x, y, subj, **kwargs):
         brokenXaxis = False
 
     # fit psychfunc
-    pars, L = psy.mle_fit_psycho(df2.transpose().values,  # extract the data from the df
-                                 P_model='erf_psycho_2gammas',
-                                 parstart=np.array(
-                                     [0, 20., 0.05, 0.05]),
-                                 parmin=np.array(
-                                     [df2['signed_contrast'].min(), 5, 0., 0.]),
-                                 parmax=np.array([df2['signed_contrast'].max(), 40., 1, 1]))
+    pars = _mle_fit_psychfunc(df2.to_numpy(dtype=float, na_value=np.nan).transpose(), cache=cache)  # extract the data from the df
+    psychfunc = lambda x: erf_psycho_2gammas(pars[None, :], x)[0]
 
     if brokenXaxis:
         # plot psychfunc
         g = sns.lineplot(x=np.arange(-27, 27),
-                         y=psy.erf_psycho_2gammas(pars, np.arange(-27, 27)), **kwargs)
+                         y=psychfunc(np.arange(-27, 27)), errorbar=None, **kwargs)
 
         # plot psychfunc: -100, +100
         sns.lineplot(x=np.arange(-36, -31),
-                     y=psy.erf_psycho_2gammas(pars, np.arange(-103, -98)), **kwargs)
+                     y=psychfunc(np.arange(-103, -98)), errorbar=None, **kwargs)
         sns.lineplot(x=np.arange(31, 36),
-                     y=psy.erf_psycho_2gammas(pars, np.arange(98, 103)), **kwargs)
+                     y=psychfunc(np.arange(98, 103)), errorbar=None, **kwargs)
 
         # if there are any points at -50, 50 left, remove those
-        if 50 in df.signed_contrast.values or -50 in df.signed_contrast.values:
-            df.drop(df[(df['signed_contrast'] == -50.) | (df['signed_contrast'] == 50)].index,
-                    inplace=True)
+        df_sj = df_sj[np.abs(df_sj['signed_contrast']) != 50]
 
         # now break the x-axis
-        df['signed_contrast'] = df['signed_contrast'].replace(-100, -35)
-        df['signed_contrast'] = df['signed_contrast'].replace(100, 35)
+        df_sj['signed_contrast'] = df_sj['signed_contrast'].replace(-100, -35)
+        df_sj['signed_contrast'] = df_sj['signed_contrast'].replace(100, 35)
 
     else:
         # plot psychfunc
         g = sns.lineplot(x=np.arange(-103, 103),
-                         y=psy.erf_psycho_2gammas(pars, np.arange(-103, 103)), **kwargs)
-
-    df3 = df.groupby(['signed_contrast', 'subject_nickname']).agg(
-        {'choice2': 'count', 'choice': 'mean'}).reset_index()
+                         y=psychfunc(np.arange(-103, 103)), errorbar=None, **kwargs)
 
     # plot datapoints with errorbars on top
     if df['subject_nickname'].nunique() > 1:
+        points = summary_errorbars(df_sj, 'signed_contrast', 'fraction', 'subject_nickname', errorbar=errorbar)
         # put the kwargs into a merged dict, so that overriding does not cause an error
-        sns.lineplot(x=df3['signed_contrast'], y=df3['choice'],
-                     **{**{'err_style':"bars",
-                     'linewidth':0, 'linestyle':'None', 'mew':0.5,
-                     'marker':'o', 'errorbar':('ci', 95)}, **kwargs})
+        _plot_errorbars(points, **{**{'linewidth':0, 'linestyle':'None', 'mew':0.5, 'marker':'o'}, **kwargs})
 
     if brokenXaxis:
         g.set_xticks([-35, -25, -12.5, 0, 12.5, 25, 35])
@@ -173,12 +521,17 @@ def plot_psychometric(x, y, subj, **kwargs):
     g.set_yticklabels(['0', '25', '50', '75', '100'])
 
 
-def plot_chronometric(x, y, subj, **kwargs):
+def plot_chronometric(x, y, subj, errorbar=('ci', 95), **kwargs):
+    """
+    Plot the median RT at each contrast, over observers. y is the RT on each trial or the rt_median
+    in each cell of utils_data.sufficient_statistics (then the same as long as there is one cell per contrast)
+    errorbar over observers: ('ci', 95) or ('se', 1), see summary_errorbars
+    """
 
     df = pd.DataFrame(
         {'signed_contrast': x, 'rt': y, 'subject_nickname': subj})
     df.dropna(inplace=True)  # ignore NaN RTs
-    df2 = df.groupby(['signed_contrast', 'subject_nickname']
+    df2 = df.groupby(['signed_contrast', 'subject_nickname'], observed=True
                      ).agg({'rt': 'median'}).reset_index()
     # df2 = df2.groupby(['signed_contrast']).mean().reset_index()
     df2 = df2[['signed_contrast', 'rt', 'subject_nickname']]
@@ -195,18 +548,12 @@ def plot_chronometric(x, y, subj, **kwargs):
     else:
         brokenXaxis = False
 
-    ax = sns.lineplot(x='signed_contrast', y='rt', err_style="bars", mew=0.5,
-                      errorbar=('ci', 95), data=df2, **kwargs)
+    points = summary_errorbars(df2, 'signed_contrast', 'rt', 'subject_nickname', errorbar=errorbar)
+    ax = _plot_errorbars(points, **{'mew':0.5, **kwargs})
 
     # all the points
     if df['subject_nickname'].nunique() > 1:
-        sns.lineplot(
-            x='signed_contrast',
-            y='rt',
-            data=df2,
-            **{**{'err_style':"bars",
-                     'linewidth':0, 'linestyle':'None', 'mew':0.5,
-                     'marker':'o', 'errorbar':('ci', 95)}, **kwargs})
+        _plot_errorbars(points, **{**{'linewidth':0, 'linestyle':'None', 'mew':0.5, 'marker':'o'}, **kwargs})
 
     if brokenXaxis:
         ax.set_xticks([-35, -25, -12.5, 0, 12.5, 25, 35])
@@ -223,6 +570,47 @@ def plot_chronometric(x, y, subj, **kwargs):
         ax.set_xlim([-110, 110])
 
 
+def summary_errorbars(df, x, y, subj, errorbar=('ci', 95), n_boot=1000, seed=0):
+    """
+    Mean of y over observers at each x, with errorbars over observers for all x at once: errorbar=('se', k) is
+    k standard errors of the mean, ('ci', level) a bootstrap confidence interval (resampling observers, as seaborn does,
+    but with the n_boot resamples of every x drawn in one go, and the same seed on every redraw).
+    df has one row per x and observer; returns x, mean, low and high
+    """
+
+    values = df.pivot_table(index=x, columns=subj, values=y, observed=True)
+    vals = np.sort(values.to_numpy(dtype=float), axis=1) # observers without data (NaN) go last
+    n = (~np.isnan(vals)).sum(axis=1)
+    mean = np.nanmean(vals, axis=1)
+
+    method, level = errorbar
+    if method == 'se':
+        sem = np.nanstd(vals, axis=1, ddof=1) / np.sqrt(n)
+        low, high = mean - level * sem, mean + level * sem
+    elif method == 'ci':
+        rng = np.random.default_rng(seed)
+        idx = (rng.random((n_boot,) + vals.shape) * n[:, None]).astype(int) # only from the observers with data
+        boot = vals[np.arange(len(vals))[None, :, None], idx]
+        boot = np.where(np.arange(vals.shape[1]) < n[:, None], boot, 0).sum(axis=2) / n
+        low, high = np.percentile(boot, [50 - level / 2, 50 + level / 2], axis=0)
+    else:
+        raise ValueError('errorbar should be (\'se\', k) or (\'ci\', level), not %s'%str(errorbar))
+
+    return pd.DataFrame({x: values.index.to_numpy(dtype=float), 'mean': mean, 'low': low, 'high': high})
+
+
+def _plot_errorbars(points, ax=None, legend=None, **kwargs):
+    """
+    Draw the output of summary_errorbars, with the same keywords as sns.lineplot(err_style='bars') where these overlap
+    """
+    ax = ax or plt.gca()
+    x = points.iloc[:, 0]
+    line, = ax.plot(x, points['mean'], **{'mec': 'w', **kwargs})
+    # the bars span the interval itself, which for a bootstrap need not be symmetric around (or contain) the mean
+    ax.vlines(x, points['low'], points['high'], colors=line.get_color(), alpha=line.get_alpha())
+    return ax
+
+
 def break_xaxis(y=0, **kwargs):
 
     # axisgate: show axis discontinuities with a quick hack
@@ -308,70 +696,62 @@ def corrfunc(x, y, **kws):
 
 
 
+# HDDM node names: parameter, optionally a condition in brackets and, for subject nodes, _subj and the subject
+# e.g. a, v(-100.0), v_std, z_prevresp, v_subj.CSHL_045, v_subj(-100.0).CSHL_045, v_Intercept_subj.CSHL_045
+hddm_node_name = r'^(?P<parameter>.+?)(?P<subj>_subj)?(?:\((?P<parameter_condition>[^()]*)\))?(?(subj)\.(?P<subj_idx>.+))$'
+
+# results that load_hddm_results has parsed, by file
+_hddm_results = {}
+
+
+def parse_hddm_nodes(names):
+    """
+    Split HDDM node names (e.g. the index of gen_stats()) into parameter, parameter_condition and subj_idx,
+    all at once (NaN for group nodes, or for parameters without a condition)
+    """
+    nodes = pd.Series(names, dtype=str).str.extract(hddm_node_name)
+    return nodes[['parameter', 'parameter_condition', 'subj_idx']]
+
+
 def results_long2wide(md):
+    """
+    One row per subject, one column per parameter and condition, from the gen_stats() output of an HDDM model
+    """
+    return results_long2wide_hddmnn(md, conditions=True)
 
-    # recode to something more useful
-    # 0. replace x_subj(yy).ZZZZ with x(yy)_subj.ZZZZ
-    md["colname_tmp"] = md["index"].replace('.+\_subj\(.+\)\..+', '.+\(.+\)\_subj\..+', regex=True)
 
-    # 1. separate the subject from the parameter
-    new = md["index"].str.split("_subj.", n=1, expand=True)
-    md["parameter"] = new[0]
-    md["subj_idx"] = new[1]
-    new = md["subj_idx"].str.split("\)\.", n=1, expand=True)
+def results_long2wide_hddmnn(md, name_col="index", val_col='mean', conditions=None):
+    """
+    One row per subject (subj_idx), one column per parameter from the gen_stats() output of an HDDM(nn) model,
+    or from full_parameter_dict of hddm_dataset_generators.simulator_h_c.
+    With conditions (by default: if any parameter depends on a condition), the columns are parameter x parameter_condition
+    ('' for parameters without one), e.g. md['v']['-100.0'], or md.columns.map(''.join) for 'v-100.0'.
+    """
 
-    # separate out subject idx and parameter value
-    for index, row in new.iterrows():
-        if row[1] == None:
-            row[1] = row[0]
-            row[0] = None
+    nodes = parse_hddm_nodes(md[name_col])
+    nodes[val_col] = pd.to_numeric(md[val_col], errors='coerce').to_numpy()
+    nodes = nodes[nodes['subj_idx'].notna()] # subject nodes only
+    if conditions is None:
+        conditions = nodes['parameter_condition'].notna().any()
 
-    md["parameter_condition"] = new[0]
-    md["subj_idx"] = new[1]
+    if conditions:
+        nodes['parameter_condition'] = nodes['parameter_condition'].fillna('')
+        columns = ['parameter', 'parameter_condition']
+    else:
+        columns = ['parameter']
 
     # pivot to put parameters as column names and subjects as row names
-    md = md.drop('index', axis=1)
-    md = md.drop('Unnamed: 0', axis=1)
-    md_wide = md.pivot_table(index=['subj_idx'], values='mean',
-                             columns=['parameter', 'parameter_condition']).reset_index()
-    return md_wide
-
-def results_long2wide_hddmnn(md, name_col="index", val_col='mean'):
-    # Anne Urai, 2022: include a little parser that returns a more manageable output
-    # can be used on full_parameter_dict from hddm_dataset_generators.simulator_h_c
-    # or on the output of gen_stats()
-    import re # regexp
-
-    # recode to something more useful
-    # 0. replace x_subj(yy).ZZZZ with x(yy)_subj.ZZZZ
-    md["colname_tmp"] = [re.sub(".+\_subj\(.+\)\..+", ".+\(.+\)\_subj\..+", i) for i in list(md[name_col])]
-
-    # 1. separate the subject from the parameter
-    new = md[name_col].str.split("_subj.", n=1, expand=True)
-    md["parameter"] = new[0]
-    md["subj_idx"] = new[1]
-
-    # only run this below if it's not a regression model!
-    if not any(md[name_col].str.contains('Intercept', case=False)) \
-        and not any(md[name_col].str.contains('indirect', case=False)):
-        new = md["subj_idx"].str.split("\)\.", n=1, expand=True)
-        # separate out subject idx and parameter value
-        for index, row in new.iterrows():
-            if row[1] == None:
-                row[1] = row[0]
-                row[0] = None
-
-        md["parameter_condition"] = new[0]
-        md["subj_idx"] = new[1]
-
-        # pivot to put parameters as column names and subjects as row names
-        md = md.drop(name_col, axis=1)
-        md_wide = md.pivot_table(index=['subj_idx'], values=val_col,
-                                 columns=['parameter', 'parameter_condition']).reset_index()
-    else:
-        # pivot to put parameters as column names and subjects as row names
-        md = md.drop(name_col, axis=1)
-        md_wide = md.pivot_table(index=['subj_idx'], values=val_col,
-                                 columns=['parameter']).reset_index()
-        
-    return md_wide
\ No newline at end of file
+    md_wide = nodes.pivot_table(index='subj_idx', columns=columns, values=val_col, aggfunc='mean')
+    return md_wide.reset_index()
+
+
+def load_hddm_results(filename, val_col='mean', conditions=None):
+    """
+    results_long2wide_hddmnn of a results file (e.g. results_combined.csv), parsed only once
+    for as long as the file does not change
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, val_col, conditions)
+    if key not in _hddm_results:
+        _hddm_results[key] = results_long2wide_hddmnn(pd.read_csv(filename), val_col=val_col, conditions=conditions)
+    return _hddm_results[key].copy()